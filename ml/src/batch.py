@@ -0,0 +1,161 @@
+"""
+Offline batch summarization over the CSV (or Parquet) files written by
+datasets/*/process.py, for backfills.
+
+Rows are streamed from the "example" column and every example is cut after its
+"<<summary>>\\n" marker to form the prompt (rows without one are wrapped in the
+mediqa format). Prompts are read a window at a time, sorted by token length so each
+batch holds similar lengths, and spread over worker processes sharing one copy of
+the weights (see replicas.py). Results are appended to a jsonl file as they finish,
+keyed by absolute file path and row; that file is also the checkpoint, a restarted
+job skips every row already in it.
+
+$ python src/batch.py models/llama-large-pile-combinedsum /mnt/d/datasets/mediqa/processed/*.csv --out=summaries.jsonl --workers=4
+"""
+
+import argparse
+import json
+import os
+import time
+from typing import Iterator, List, Set, Tuple
+
+import pandas as pd
+
+# This is a very hacky and temporary solution to make this work as a standalone script
+try:
+    from src.model import Transformer
+    from src.replicas import ReplicaPool
+    from src.tokenizer import Tokenizer
+except ImportError:
+    from model import Transformer
+    from replicas import ReplicaPool
+    from tokenizer import Tokenizer
+
+
+def read_rows(path: str, column: str, chunksize: int = 4096) -> Iterator[Tuple[int, str]]:
+    """(row index, text) of one file without loading it whole"""
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            # no pyarrow: pandas picks another engine but reads the file at once
+            df = pd.read_parquet(path, columns=[column])
+            yield from enumerate(df[column].tolist())
+            return
+        offset = 0
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=[column]):
+            for i, text in enumerate(batch.column(0).to_pylist()):
+                yield offset + i, text
+            offset += batch.num_rows
+    else:
+        # process.py writes with escapechar="\\"
+        for chunk in pd.read_csv(path, usecols=[column], chunksize=chunksize, escapechar="\\"):
+            for i, text in zip(chunk.index, chunk[column]):
+                yield int(i), text
+
+
+def to_prompt(text: str, marker: str = "<<summary>>\n") -> str:
+    if marker in text:
+        return text[: text.index(marker) + len(marker)]
+    return f"<<context>>\n{text.strip()}\n\n{marker}"
+
+
+def load_done(out_path: str) -> Set[Tuple[str, int]]:
+    """rows already written by an earlier run; a line cut short by a kill is ignored"""
+    done = set()
+    if not os.path.exists(out_path):
+        return done
+    with open(out_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done.add((record["file"], record["row"]))
+    return done
+
+
+def run(
+    pool: ReplicaPool,
+    tokenizer: Tokenizer,
+    paths: List[str],
+    out_path: str,
+    column: str = "example",
+    window: int = 1024,
+    max_new_tokens: int = 256,
+):
+    done = load_done(out_path)
+    out = open(out_path, "a")
+    if os.path.getsize(out_path) > 0:
+        # keep a partially written last line on its own so it is skipped next time
+        with open(out_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                out.write("\n")
+    pending = {}  # job id -> (absolute path, row)
+    written, t0 = 0, time.time()
+
+    def collect(limit: int):
+        nonlocal written
+        while len(pending) > limit:
+            job_id, output, finish_reason = pool.result()
+            name, row = pending.pop(job_id)
+            record = {
+                "file": name,
+                "row": row,
+                "summary": tokenizer.decode(output),
+                "finish_reason": finish_reason,
+            }
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            written += 1
+            if written % 100 == 0:
+                print(f"{written} rows | {written / (time.time() - t0):.2f} rows/s")
+
+    def submit(batch: List[Tuple[str, int, List[int]]]):
+        # length buckets: similar lengths reach the workers together
+        for name, row, tokens in sorted(batch, key=lambda x: len(x[2])):
+            pending[pool.submit(tokens, max_new_tokens)] = (name, row)
+        collect(window)  # at most two windows in flight
+
+    batch = []
+    for path in paths:
+        # the full path: process.py shards such as 0.csv repeat across dataset directories
+        name = os.path.abspath(path)
+        for row, text in read_rows(path, column):
+            if (name, row) in done or not isinstance(text, str):
+                continue
+            batch.append((name, row, tokenizer.encode(to_prompt(text), bos=True, eos=False)))
+            if len(batch) == window:
+                submit(batch)
+                batch = []
+    if batch:
+        submit(batch)
+    collect(0)
+    out.close()
+    print(f"wrote {written} rows to {out_path}, {len(done)} were already done")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_dir", type=str)
+    parser.add_argument("inputs", type=str, nargs="+", help="CSV or Parquet files.")
+    parser.add_argument("--out", type=str, required=True, help="jsonl results, also the checkpoint.")
+    parser.add_argument("--column", type=str, default="example")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads_per_worker", type=int, default=None)
+    parser.add_argument("--max_batch_size", type=int, default=16, help="Engine slots per worker.")
+    parser.add_argument("--window", type=int, default=1024, help="Rows sorted into length buckets at once.")
+    parser.add_argument("--max_new_tokens", type=int, default=256)
+    args = parser.parse_args()
+
+    enc = Tokenizer()
+    pool = ReplicaPool(
+        Transformer.from_pretrained(args.model_dir, "cpu"),
+        args.workers,
+        args.threads_per_worker,
+        max_batch_size=args.max_batch_size,
+        eos_id=enc.eos_id,
+    )
+    run(pool, enc, args.inputs, args.out, args.column, args.window, args.max_new_tokens)
+    pool.close()
@@ -0,0 +1,176 @@
+"""
+Beam search over a paged key/value cache.
+
+The prompt is prefilled once. Every beam is a block table in the allocator of
+paged_cache.py: a new beam forks its parent's table (fork only bumps reference
+counts), so reordering beams moves block indices around rather than cache
+contents, and the prompt blocks stay shared by all beams. A shared block is
+copied only when a beam writes into it, which after the prompt is the partially
+filled last block. Example:
+
+$ python src/beam.py models/llama-large-pile-combinedsum --num_beams=4 --length_penalty=1.0
+"""
+
+import argparse
+from dataclasses import dataclass
+from typing import Hashable, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+# This is a very hacky and temporary solution to make this work as a standalone script
+try:
+    from src.model import Transformer
+    from src.paged_cache import block_bytes, setup_paged_caches
+    from src.tokenizer import Tokenizer
+except ImportError:
+    from model import Transformer
+    from paged_cache import block_bytes, setup_paged_caches
+    from tokenizer import Tokenizer
+
+
+@dataclass
+class Beam:
+    key: Hashable  # block table in the allocator
+    tokens: List[int]  # generated so far
+    score: float  # summed log-probability
+
+
+@dataclass
+class BeamStats:
+    steps: int = 0
+    peak_blocks: int = 0  # cache blocks in use at once
+    unshared_blocks: int = 0  # what num_beams private caches would have needed
+
+
+class BeamSearch:
+    def __init__(
+        self,
+        model: Transformer,
+        num_beams: int = 4,
+        length_penalty: float = 1.0,
+        early_stopping: bool = True,
+        block_size: int = 16,
+    ):
+        self.model = model
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.early_stopping = early_stopping
+        self.block_size = block_size
+        self.stats = BeamStats()
+
+    def _normalize(self, score: float, length: int) -> float:
+        return score / max(length, 1) ** self.length_penalty
+
+    def _done(self, finished: List[Tuple[float, List[int]]], beams: List[Beam], max_length: int) -> bool:
+        if not beams:
+            return True
+        if len(finished) < self.num_beams:
+            return False
+        if self.early_stopping:
+            return True
+        # log-probabilities only fall, stop once no live beam can beat the kept hypotheses.
+        # With length_penalty > 0 a longer hypothesis divides by more, so the best a beam
+        # can still reach is its current score spread over max_length tokens
+        worst = sorted(finished, key=lambda x: x[0], reverse=True)[self.num_beams - 1][0]
+        best = max(
+            self._normalize(b.score, max_length if self.length_penalty > 0 else len(b.tokens)) for b in beams
+        )
+        return best <= worst
+
+    @torch.inference_mode()
+    def generate(self, idx: torch.Tensor, max_new_tokens: int, eos_id: Optional[int] = None):
+        """same contract as Transformer.generate for a single sequence idx of shape (1, t)"""
+        assert idx.size(0) == 1, "beam search runs one sequence at a time"
+        model, device = self.model, idx.device
+        max_seq_len = model.params.max_seq_len
+        prompt = idx[0, -max(1, max_seq_len - max_new_tokens) :].tolist()
+        max_new_tokens = min(max_new_tokens, max_seq_len - len(prompt))
+
+        # worst case every beam owns all its blocks, plus the prompt and one spare per beam
+        def n_blocks(n: int) -> int:
+            return (n + self.block_size - 1) // self.block_size
+
+        total = (n_blocks(len(prompt) + max_new_tokens) + 1) * self.num_beams + n_blocks(len(prompt)) + 1
+        allocator = setup_paged_caches(model, total * block_bytes(model, self.block_size), self.block_size)
+
+        beams = [Beam("prompt", [], 0.0)]
+        finished: List[Tuple[float, List[int]]] = []  # (normalized score, tokens)
+        feed, pos = [prompt], 0
+        for step in range(max_new_tokens):
+            keys = [b.key for b in beams]
+            seqlen = len(feed[0])
+            for key in keys:
+                # copy-on-write: only a block still shared with a sibling is duplicated
+                assert allocator.reserve(key, pos, pos + seqlen), "kv budget exhausted"
+            allocator.prepare(
+                keys, [pos] * len(keys), [seqlen] * len(keys), seqlen, max_seq_len, device
+            )
+            used = allocator.num_blocks - 1 - allocator.num_free_blocks
+            self.stats.peak_blocks = max(self.stats.peak_blocks, used)
+            logits = model(torch.tensor(feed, device=device), start_pos=pos)
+            logprobs = F.log_softmax(logits[:, -1, :].float(), dim=-1)
+            pos += seqlen
+
+            scores = torch.tensor([b.score for b in beams], device=device)[:, None] + logprobs
+            top_scores, top_idx = scores.view(-1).topk(min(2 * self.num_beams, scores.numel()))
+            new = []
+            for score, i in zip(top_scores.tolist(), top_idx.tolist()):
+                parent, token = divmod(i, logprobs.size(-1))
+                tokens = beams[parent].tokens + [token]
+                if token == eos_id:
+                    finished.append((self._normalize(score, len(tokens)), tokens))
+                    continue
+                new.append((parent, tokens, score))
+                if len(new) == self.num_beams:
+                    break
+
+            # reorder by index: every survivor shares its parent's blocks, nothing is copied
+            next_beams = []
+            for j, (parent, tokens, score) in enumerate(new):
+                key = (step, j)
+                allocator.fork(beams[parent].key, key, pos)
+                next_beams.append(Beam(key, tokens, score))
+            for key in keys:
+                allocator.free(key)
+            beams = next_beams
+            feed = [[b.tokens[-1]] for b in beams]
+            self.stats.steps += 1
+            if self._done(finished, beams, max_new_tokens):
+                break
+
+        for b in beams:
+            finished.append((self._normalize(b.score, len(b.tokens)), b.tokens))
+            allocator.free(b.key)
+        self.stats.unshared_blocks = max(
+            self.stats.unshared_blocks, self.num_beams * n_blocks(len(prompt) + max_new_tokens)
+        )
+        model.reset_caches()
+        best = max(finished, key=lambda x: x[0])[1]
+        new_tokens = torch.tensor([best], dtype=idx.dtype, device=device)
+        return torch.cat((idx, new_tokens), dim=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_dir", type=str)
+    parser.add_argument("--prompt", type=str, default="<<context>>\n")
+    parser.add_argument("--num_beams", type=int, default=4)
+    parser.add_argument("--length_penalty", type=float, default=1.0)
+    parser.add_argument("--no_early_stopping", action="store_true")
+    parser.add_argument("--max_new_tokens", type=int, default=256)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    enc = Tokenizer()
+    search = BeamSearch(
+        Transformer.from_pretrained(args.model_dir, args.device),
+        num_beams=args.num_beams,
+        length_penalty=args.length_penalty,
+        early_stopping=not args.no_early_stopping,
+    )
+    idx = torch.tensor([enc.encode(args.prompt, bos=True, eos=False)], device=args.device)
+    out = search.generate(idx, args.max_new_tokens, eos_id=enc.eos_id)
+    print(enc.decode(out[0, idx.size(1) :].tolist()))
+    s = search.stats
+    print(f"{s.steps} steps | peak {s.peak_blocks} cache blocks vs {s.unshared_blocks} without sharing")
@@ -0,0 +1,106 @@
+"""
+Throughput of the unfused and fused (wqkv / w13) projection layouts on the same
+weights, for prefill and for single-token decode steps. With --loss_chunk_size the
+chunked training loss is instead checked against the full-logits loss (value,
+gradients and, on cuda, peak memory). Without a model directory a randomly
+initialized model of the train.py default size is used. Example:
+
+$ python src/benchmark.py --model_dir=models/llama-large-pile-combinedsum --batch_size=8 --threads=8
+$ python src/benchmark.py --device=cuda --batch_size=8 --prompt_len=2048 --loss_chunk_size=2048
+"""
+
+import argparse
+import time
+
+import torch
+
+# This is a very hacky and temporary solution to make this work as a standalone script
+try:
+    from src.model import ModelArgs, Transformer
+except ImportError:
+    from model import ModelArgs, Transformer
+
+
+@torch.inference_mode()
+def throughput(model: Transformer, batch_size: int, prompt_len: int, decode_steps: int, iters: int = 3):
+    """(prefill tokens/s, decode tokens/s), best of iters runs after one warmup"""
+    device = model.norm.weight.device
+    tokens = torch.randint(model.vocab_size, (batch_size, prompt_len + decode_steps), device=device)
+    best_prefill, best_decode = 0.0, 0.0
+    for it in range(iters + 1):
+        model.setup_caches(batch_size, prompt_len + decode_steps)
+        t0 = time.perf_counter()
+        model(tokens[:, :prompt_len], start_pos=0)
+        t1 = time.perf_counter()
+        for pos in range(prompt_len, prompt_len + decode_steps):
+            model(tokens[:, pos : pos + 1], start_pos=pos)
+        t2 = time.perf_counter()
+        if it > 0:
+            best_prefill = max(best_prefill, batch_size * prompt_len / (t1 - t0))
+            best_decode = max(best_decode, batch_size * decode_steps / (t2 - t1))
+    model.reset_caches()
+    return best_prefill, best_decode
+
+
+def loss_check(model: Transformer, batch_size: int, seqlen: int, chunk_size: int):
+    """(loss difference, largest gradient difference, peak bytes full, peak bytes chunked)"""
+    device = model.norm.weight.device
+    tokens = torch.randint(model.vocab_size, (batch_size, seqlen + 1), device=device)
+    targets = tokens[:, 1:].clone()
+    targets[:, : seqlen // 8] = -1  # exercise ignore_index
+    model.eval()  # no dropout, both runs see the same function
+    results = []
+    for loss_chunk_size in (0, chunk_size):
+        model.loss_chunk_size = loss_chunk_size
+        model.zero_grad(set_to_none=True)
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+        model(tokens[:, :-1], targets)
+        model.last_loss.backward()
+        peak = torch.cuda.max_memory_allocated(device) if device.type == "cuda" else 0
+        grads = [p.grad.clone() for p in model.parameters()]
+        results.append((model.last_loss.item(), grads, peak))
+    model.loss_chunk_size = 0
+    (full, full_grads, full_peak), (chunked, chunked_grads, chunked_peak) = results
+    grad_diff = max((a - b).abs().max().item() for a, b in zip(full_grads, chunked_grads))
+    return abs(full - chunked), grad_diff, full_peak, chunked_peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_dir", type=str, default="", help="Random train.py-sized model if empty.")
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--prompt_len", type=int, default=256)
+    parser.add_argument("--decode_steps", type=int, default=64)
+    parser.add_argument("--iters", type=int, default=3)
+    parser.add_argument("--loss_chunk_size", type=int, default=0, help="Check the chunked loss instead.")
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, 0 keeps the default")
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    if args.model_dir:
+        unfused = Transformer.from_pretrained(args.model_dir, args.device)
+    else:
+        params = ModelArgs(dim=768, n_layers=12, n_heads=12, vocab_size=32000, multiple_of=32)
+        unfused = Transformer(params).to(args.device).eval()
+    if args.loss_chunk_size > 0:
+        loss_diff, grad_diff, full_peak, chunked_peak = loss_check(
+            unfused, args.batch_size, args.prompt_len, args.loss_chunk_size
+        )
+        print(f"loss diff {loss_diff:.2e} | max grad diff {grad_diff:.2e}")
+        if full_peak:
+            print(f"peak memory full {full_peak / 2**20:.0f}MB | chunked {chunked_peak / 2**20:.0f}MB")
+        raise SystemExit
+    fused = Transformer(ModelArgs(**dict(vars(unfused.params), fused=True))).to(args.device).eval()
+    # the load hook concatenates the unfused keys, so both models hold the same weights
+    fused.load_state_dict(unfused.state_dict())
+
+    results = {}
+    for name, model in [("unfused", unfused), ("fused", fused)]:
+        results[name] = throughput(model, args.batch_size, args.prompt_len, args.decode_steps, args.iters)
+        print(f"{name:8s} prefill {results[name][0]:10.1f} tokens/s | decode {results[name][1]:8.1f} tokens/s")
+    print(
+        f"speedup  prefill {results['fused'][0] / results['unfused'][0]:.3f}x | decode {results['fused'][1] / results['unfused'][1]:.3f}x"
+    )
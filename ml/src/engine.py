@@ -0,0 +1,331 @@
+"""
+Continuous-batching generation over the native Transformer.
+
+Every slot of the kv cache holds one sequence. Each step feeds the pending tokens
+of all active slots through one forward pass (new prompts in chunks of at most
+prefill_chunk tokens, running sequences one token), retires sequences as soon as
+they emit eos or run out of budget, and backfills the freed slots from the queue.
+With a paged allocator (see paged_cache.py) admission is limited by free cache
+blocks rather than slots, and when blocks run out the youngest sequence is
+preempted and recomputed later. kv_int8=True keeps the contiguous caches as int8
+(model.Int8KVCache), fitting about twice the slots in the same memory. Example:
+
+>>> engine = Engine(model, max_batch_size=16, eos_id=tokenizer.eos_id)
+>>> for req in engine.run([Request(tokenizer.encode(t, bos=True, eos=False)) for t in texts]):
+...     print(tokenizer.decode(req.output))
+"""
+
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Iterable, Iterator, List, Optional
+
+import torch
+
+# This is a very hacky and temporary solution to make this work as a standalone script
+try:
+    from src.lora import AdapterSet
+    from src.model import Transformer, sample
+    from src.paged_cache import BlockAllocator
+    from src.prefix_cache import PrefixCache
+except ImportError:
+    from lora import AdapterSet
+    from model import Transformer, sample
+    from paged_cache import BlockAllocator
+    from prefix_cache import PrefixCache
+
+
+@dataclass(eq=False)
+class Request:
+    tokens: List[int]  # prompt token ids
+    max_new_tokens: int = 256
+    request_id: Any = None
+    output: List[int] = field(default_factory=list)
+    finish_reason: Optional[str] = None  # "eos" | "length" | "stop" | "error" once retired
+    skeleton: Any = None  # optional structured.Skeleton forcing parts of the output
+    adapter: Optional[str] = None  # name of a lora.AdapterSet adapter, None for the base model
+
+    # scheduler state
+    seq_id: int = -1  # admission order, also the block table key when paged
+    pos: int = 0  # number of tokens already in the kv cache
+    pending: List[int] = field(default_factory=list)  # tokens still to be forwarded
+    prompt_done: bool = False  # the prompt has been prefilled at least once
+
+
+@dataclass
+class EngineStats:
+    steps: int = 0
+    prompt_tokens: int = 0
+    generated_tokens: int = 0
+    forced_tokens: int = 0  # appended from a skeleton without a decode step
+    finished: int = 0
+    preempted: int = 0
+    occupied_slots: int = 0  # summed over steps
+    busy_time: float = 0.0  # seconds spent inside step()
+
+    @property
+    def tokens_per_sec(self) -> float:
+        return self.generated_tokens / self.busy_time if self.busy_time > 0 else 0.0
+
+    @property
+    def mean_occupancy(self) -> float:
+        return self.occupied_slots / self.steps if self.steps > 0 else 0.0
+
+
+class Engine:
+    def __init__(
+        self,
+        model: Transformer,
+        max_batch_size: int = 8,
+        eos_id: Optional[int] = None,
+        temperature: float = 0.0,
+        top_k: Optional[int] = None,
+        prefill_chunk: int = 512,
+        pad_id: int = 0,
+        prefix_cache: Optional[PrefixCache] = None,
+        allocator: Optional[BlockAllocator] = None,
+        kv_int8: bool = False,
+        adapters: Optional[AdapterSet] = None,
+    ):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_seq_len = model.params.max_seq_len
+        self.eos_id = eos_id
+        self.temperature = temperature
+        self.top_k = top_k
+        self.prefill_chunk = prefill_chunk
+        self.pad_id = pad_id
+        self.prefix_cache = prefix_cache
+        self.allocator = allocator
+        self.adapters = adapters
+        self.device = model.norm.weight.device
+
+        self.queue: Deque[Request] = deque()
+        self.slots: List[Optional[Request]] = [None] * max_batch_size
+        self.stats = EngineStats()
+        self._next_seq_id = 0
+        if allocator is None:
+            model.setup_caches(max_batch_size, kv_int8=kv_int8)
+        elif prefix_cache is not None:
+            # paged prefixes are pinned block tables, release them on eviction
+            prefix_cache.on_evict = allocator.free
+
+    def submit(self, request: Request) -> Request:
+        assert len(request.tokens) > 0, "empty prompt"
+        if request.adapter is not None:
+            assert self.adapters is not None and request.adapter in self.adapters.index, (
+                f"unknown adapter {request.adapter}"
+            )
+        # crop over-long prompts from the left, leaving room for the response
+        keep = max(1, self.max_seq_len - request.max_new_tokens)
+        request.tokens = request.tokens[-keep:]
+        # counted here, once: preemption requeues without resubmitting
+        self.stats.prompt_tokens += len(request.tokens)
+        if self.allocator is not None:
+            need = self.allocator.blocks_for(len(request.tokens) + request.max_new_tokens)
+            assert need < self.allocator.num_blocks, "request larger than the whole kv budget"
+        request.pos = 0
+        request.pending = list(request.tokens)
+        request.output = []
+        request.finish_reason = None
+        request.prompt_done = False
+        if request.skeleton is not None:
+            # a skeleton that opens with a literal extends the prompt right away
+            forced = request.skeleton.start()
+            request.output.extend(forced)
+            request.pending.extend(forced)
+            self.stats.forced_tokens += len(forced)
+        self.queue.append(request)
+        return request
+
+    def cancel(self, request: Request, reason: str = "stop"):
+        """retire a request before its next step (e.g. on a stop string), freeing its slot"""
+        if request in self.queue:
+            self.queue.remove(request)
+        for i, r in enumerate(self.slots):
+            if r is request:
+                self._release(i)
+        if request.finish_reason is None:
+            request.finish_reason = reason
+            self.stats.finished += 1
+
+    def has_work(self) -> bool:
+        return bool(self.queue) or any(r is not None for r in self.slots)
+
+    def _release(self, i: int):
+        if self.allocator is not None:
+            self.allocator.free(self.slots[i].seq_id)
+        self.slots[i] = None
+
+    def _admit(self):
+        # take the lowest free slots first so the active rows stay packed at the front
+        for i in range(self.max_batch_size):
+            if not self.queue:
+                break
+            if self.slots[i] is not None:
+                continue
+            req = self.queue[0]
+            if self.allocator is not None and not self.allocator.can_allocate(
+                len(req.pending) + self.allocator.block_size
+            ):
+                break  # wait for blocks to free up, keeping arrival order
+            self.queue.popleft()
+            self.slots[i] = req
+            req.seq_id = self._next_seq_id
+            self._next_seq_id += 1
+            if self.prefix_cache is not None and req.adapter is None:
+                # skip prefilling a cached template preamble (base model keys/values only)
+                length, kv = self.prefix_cache.lookup(req.pending)
+                if length > 0:
+                    if self.allocator is not None:
+                        self.allocator.fork(kv, req.seq_id, length)
+                    else:
+                        self.model.write_kv(i, kv)
+                    req.pos = length
+                    req.pending = req.pending[length:]
+
+    def _preempt(self, i: int):
+        # give the slot's blocks back and requeue the sequence to be recomputed from scratch
+        req = self.slots[i]
+        self._release(i)
+        req.pending = req.tokens + req.output
+        req.pos = 0
+        self.queue.appendleft(req)
+        self.stats.preempted += 1
+
+    def _reserve(self, active: List[int], chunk: int) -> List[int]:
+        # oldest sequences get blocks first, the youngest are preempted until everyone fits
+        for i in sorted(active, key=lambda i: self.slots[i].seq_id):
+            req = self.slots[i]
+            if req is None:
+                continue
+            end = req.pos + min(len(req.pending), chunk)
+            while not self.allocator.reserve(req.seq_id, req.pos, end):
+                victim = max(
+                    (j for j in active if self.slots[j] is not None),
+                    key=lambda j: self.slots[j].seq_id,
+                )
+                self._preempt(victim)
+                if victim == i:
+                    break
+        return [i for i in active if self.slots[i] is not None]
+
+    @torch.inference_mode()
+    def step(self) -> List[Request]:
+        """run one batched forward pass, returns the requests that finished in it"""
+        t0 = time.time()
+        self._admit()
+        active = [i for i, r in enumerate(self.slots) if r is not None]
+        if not active:
+            return []
+
+        # only forward the rows up to the last occupied slot, right-padded to the
+        # longest pending chunk; free rows inside that range just rewrite position 0
+        n_rows = active[-1] + 1
+        chunk = min(max(len(self.slots[i].pending) for i in active), self.prefill_chunk)
+        if self.allocator is not None:
+            active = self._reserve(active, chunk)
+            if not active:
+                return []
+            n_rows = active[-1] + 1
+            chunk = min(max(len(self.slots[i].pending) for i in active), self.prefill_chunk)
+        tokens = torch.full((n_rows, chunk), self.pad_id, dtype=torch.long)
+        start_pos = torch.zeros(n_rows, dtype=torch.long)
+        seqlens = torch.ones(n_rows, dtype=torch.long)
+        fed = {}
+        for i in active:
+            req = self.slots[i]
+            feed = req.pending[:chunk]
+            tokens[i, : len(feed)] = torch.tensor(feed, dtype=torch.long)
+            start_pos[i] = req.pos
+            seqlens[i] = len(feed)
+            fed[i] = len(feed)
+        if self.allocator is not None:
+            keys = [self.slots[i].seq_id if self.slots[i] is not None else None for i in range(n_rows)]
+            self.allocator.prepare(
+                keys, start_pos.tolist(), seqlens.tolist(), chunk, self.max_seq_len, self.device
+            )
+        if self.adapters is not None:
+            self.adapters.set_batch(
+                [self.slots[i].adapter if self.slots[i] is not None else None for i in range(n_rows)],
+                self.device,
+            )
+
+        try:
+            logits = self.model(
+                tokens.to(self.device),
+                start_pos=start_pos.to(self.device),
+                seqlens=seqlens.to(self.device),
+            )
+        finally:
+            if self.adapters is not None:
+                # other callers of the model (generate, sessions) get the bare base
+                self.adapters.ids = None
+        idx_next = sample(logits[:, -1, :], self.temperature, self.top_k).view(-1).tolist()
+
+        finished = []
+        for i in active:
+            req = self.slots[i]
+            req.pos += fed[i]
+            req.pending = req.pending[fed[i] :]
+            if req.pending:
+                continue  # still chunking through the prompt
+            if self.prefix_cache is not None and req.adapter is None and not req.prompt_done:
+                # prompt fully cached now, keep any registered prefix for later requests
+                for length in self.prefix_cache.missing(req.tokens):
+                    if self.allocator is not None:
+                        # pin the prefix blocks under their own key, shared copy-on-write
+                        key = ("prefix", tuple(req.tokens[:length]))
+                        self.allocator.fork(req.seq_id, key, length)
+                        self.prefix_cache.insert(
+                            req.tokens[:length], key, self.allocator.bytes_for(length)
+                        )
+                    else:
+                        self.prefix_cache.insert(req.tokens[:length], self.model.read_kv(i, length))
+            req.prompt_done = True
+            token = idx_next[i]
+            req.output.append(token)
+            self.stats.generated_tokens += 1
+            forced, complete = [], False
+            if req.skeleton is not None and token != self.eos_id:
+                # tokens the skeleton dictates go into the next chunk without sampling
+                forced, complete = req.skeleton.advance(token)
+                req.output.extend(forced)
+                self.stats.forced_tokens += len(forced)
+            if self.eos_id is not None and token == self.eos_id:
+                req.finish_reason = "eos"
+            elif complete:
+                req.finish_reason = "stop"
+            elif (
+                len(req.output) >= req.max_new_tokens
+                or req.pos + 1 + len(forced) > self.max_seq_len
+            ):
+                req.finish_reason = "length"
+            else:
+                req.pending = [token] + forced
+                continue
+            self._release(i)
+            finished.append(req)
+
+        self.stats.steps += 1
+        self.stats.occupied_slots += len(active)
+        self.stats.finished += len(finished)
+        self.stats.busy_time += time.time() - t0
+        return finished
+
+    def run(self, requests: Iterable[Request]) -> Iterator[Request]:
+        """submit all requests and yield them back in completion order"""
+        for request in requests:
+            self.submit(request)
+        while self.has_work():
+            yield from self.step()
+
+    def generate(self, prompts: List[List[int]], max_new_tokens: int = 256) -> List[List[int]]:
+        """convenience wrapper: complete a list of ragged prompts, keeping input order"""
+        requests = [
+            Request(tokens=p, max_new_tokens=max_new_tokens, request_id=i)
+            for i, p in enumerate(prompts)
+        ]
+        for _ in self.run(requests):
+            pass
+        return [r.output for r in requests]
@@ -0,0 +1,69 @@
+"""
+Turn a multi-head attention checkpoint into grouped-query attention for uptraining.
+
+The key and value heads of every group of n_heads // n_kv_heads consecutive heads
+are mean-pooled into one head, which keeps the query heads and everything else
+untouched. The pooled model starts close to the original and recovers with a short
+round of continued training (a few percent of the pretraining steps), after which
+its kv cache is n_heads / n_kv_heads times smaller.
+
+$ python src/gqa.py models/llama-large-pile models/llama-large-pile-gqa4 --n_kv_heads=4
+$ python train.py --in_dir=models/llama-large-pile-gqa4 --out_dir=models/llama-large-pile-gqa4 --dataset=...
+
+The optimizer state is dropped since the key/value shapes change.
+"""
+
+import argparse
+import os
+
+import torch
+
+
+def group_heads(w: torch.Tensor, n_heads: int, n_kv_heads: int) -> torch.Tensor:
+    """mean-pool a (n_heads * head_dim, dim) projection into (n_kv_heads * head_dim, dim)"""
+    assert n_heads % n_kv_heads == 0, "n_kv_heads must divide n_heads"
+    head_dim = w.size(0) // n_heads
+    return (
+        w.view(n_kv_heads, n_heads // n_kv_heads, head_dim, w.size(1))
+        .float()
+        .mean(dim=1)
+        .reshape(n_kv_heads * head_dim, w.size(1))
+        .to(w.dtype)
+    )
+
+
+def convert(checkpoint: dict, n_kv_heads: int) -> dict:
+    """resume.pt_ckpt contents with the wk / wv heads pooled down to n_kv_heads"""
+    model_args = dict(checkpoint["model_args"])
+    n_heads = model_args["n_heads"]
+    assert (model_args["n_kv_heads"] or n_heads) == n_heads, "checkpoint already uses grouped heads"
+    state_dict = {}
+    for k, v in checkpoint["model"].items():
+        if k.endswith("attention.wk.weight") or k.endswith("attention.wv.weight"):
+            v = group_heads(v, n_heads, n_kv_heads)
+        state_dict[k] = v
+    model_args["n_kv_heads"] = n_kv_heads
+    converted = {k: v for k, v in checkpoint.items() if k != "optimizer"}
+    converted["model"] = state_dict
+    converted["model_args"] = model_args
+    # the pooled model starts out worse, don't early-stop against the MHA loss
+    converted["best_val_loss"] = 1e9
+    return converted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("in_dir", type=str, help="train.py output directory with resume.pt_ckpt.")
+    parser.add_argument("out_dir", type=str)
+    parser.add_argument("--n_kv_heads", type=int, required=True)
+    args = parser.parse_args()
+
+    checkpoint = torch.load(os.path.join(args.in_dir, "resume.pt_ckpt"), map_location="cpu")
+    converted = convert(checkpoint, args.n_kv_heads)
+    os.makedirs(args.out_dir, exist_ok=True)
+    torch.save(converted, os.path.join(args.out_dir, "resume.pt_ckpt"))
+
+    n_heads = converted["model_args"]["n_heads"]
+    print(
+        f"pooled {n_heads} key/value heads into {args.n_kv_heads}, kv cache {n_heads / args.n_kv_heads:.1f}x smaller"
+    )
@@ -0,0 +1,214 @@
+"""
+Check and choose between the kernel backends registered in model.py.
+
+Every op (rmsnorm, rotary, attention) has an "eager" reference, plus "compiled"
+(torch.compile of the eager code) where available. Attention also has "sdpa"
+(scaled_dot_product_attention, the default on PyTorch >= 2.0) and "chunked", which
+processes a block of queries at a time so CPU prefill never holds the full
+seqlen x kv_len score matrix. The masked eager paths share one causal mask per
+device instead of a max_seq_len x max_seq_len buffer per layer.
+
+$ python src/kernels.py --check                      # every backend against eager
+$ python src/kernels.py --autotune --seqlen=1024     # fastest correct backend per op
+
+Backends are picked with a spec string such as "attention=chunked,rmsnorm=compiled",
+or "auto" to benchmark at startup, e.g. train.py --kernels=auto.
+"""
+
+import argparse
+import time
+from typing import Dict, List, Tuple
+
+import torch
+
+# This is a very hacky and temporary solution to make this work as a standalone script
+try:
+    from src.model import KERNELS, ModelArgs, causal_mask, get_kernels, precompute_freqs_cis, set_kernels
+except ImportError:
+    from model import KERNELS, ModelArgs, causal_mask, get_kernels, precompute_freqs_cis, set_kernels
+
+TOLERANCES = {torch.float32: 1e-4, torch.bfloat16: 2e-2, torch.float16: 5e-3}
+
+
+def parse_kernels(spec: str) -> Dict[str, str]:
+    """"attention=chunked,rmsnorm=compiled" -> {"attention": "chunked", "rmsnorm": "compiled"}"""
+    choices = {}
+    for item in filter(None, spec.split(",")):
+        op, _, name = item.partition("=")
+        assert name, f"expected op=backend, got {item!r}"
+        choices[op.strip()] = name.strip()
+    return choices
+
+
+def cases(op: str, params: ModelArgs, batch_size: int, seqlen: int, dtype, device) -> Dict[str, tuple]:
+    """named argument tuples for op at the model's shapes"""
+    head_dim = params.dim // params.n_heads
+    n_kv_heads = params.n_kv_heads or params.n_heads
+
+    def randn(*shape):
+        return torch.randn(*shape, dtype=dtype, device=device)
+
+    if op == "rmsnorm":
+        weight = 1 + 0.1 * randn(params.dim)
+        return {
+            "prefill": (randn(batch_size, seqlen, params.dim), weight, params.norm_eps),
+            "decode": (randn(batch_size, 1, params.dim), weight, params.norm_eps),
+        }
+    if op == "rotary":
+        cos, sin = precompute_freqs_cis(head_dim, seqlen)
+        cos, sin = cos.to(device), sin.to(device)
+        # per-row positions, as in batched decoding with different offsets
+        pos = torch.randint(seqlen, (batch_size, 1), device=device)
+        return {
+            "prefill": (
+                randn(batch_size, seqlen, params.n_heads, head_dim),
+                randn(batch_size, seqlen, n_kv_heads, head_dim),
+                cos,
+                sin,
+            ),
+            "per_row": (
+                randn(batch_size, 1, params.n_heads, head_dim),
+                randn(batch_size, 1, n_kv_heads, head_dim),
+                cos[pos],
+                sin[pos],
+            ),
+        }
+    assert op == "attention", f"unknown op {op}"
+
+    def qkv(q_len, kv_len):
+        return (
+            randn(batch_size, params.n_heads, q_len, head_dim),
+            randn(batch_size, params.n_heads, kv_len, head_dim),
+            randn(batch_size, params.n_heads, kv_len, head_dim),
+        )
+
+    chunk = seqlen // 3 + 1  # a chunk of new tokens on top of a cached prefix
+    offsets = torch.randint(seqlen - chunk + 1, (batch_size,), device=device)
+    return {
+        "causal": qkv(seqlen, seqlen) + (None, True, 0.0),
+        "decode": qkv(1, seqlen) + (None, False, 0.0),
+        "cached_prefix": qkv(chunk, seqlen) + (causal_mask(seqlen - chunk, chunk, seqlen, device), False, 0.0),
+        "per_row_mask": qkv(chunk, seqlen) + (causal_mask(offsets, chunk, seqlen, device), False, 0.0),
+    }
+
+
+def check(
+    params: ModelArgs, batch_size: int = 2, seqlen: int = 600, dtypes=(torch.float32, torch.bfloat16), device="cpu"
+) -> List[Tuple[str, str, str, str, float, bool]]:
+    """(op, backend, dtype, case, max abs error vs eager, ok) for every registered backend"""
+    results = []
+    for op, backends in KERNELS.items():
+        reference = backends["eager"]
+        for dtype in dtypes:
+            for case, args in cases(op, params, batch_size, seqlen, dtype, device).items():
+                # compare in float32 against the float32 reference
+                args32 = tuple(a.float() if torch.is_tensor(a) and a.is_floating_point() else a for a in args)
+                expected = reference(*args32)
+                for name, fn in backends.items():
+                    try:
+                        out = fn(*args)
+                    except Exception as e:  # e.g. torch.compile without a working compiler
+                        print(f"{op}/{name} failed: {type(e).__name__}: {e}")
+                        results.append((op, name, str(dtype), case, float("inf"), False))
+                        continue
+                    outs = out if isinstance(out, tuple) else (out,)
+                    refs = expected if isinstance(expected, tuple) else (expected,)
+                    err = max((o.float() - r).abs().max().item() for o, r in zip(outs, refs))
+                    scale = max(r.abs().max().item() for r in refs)
+                    results.append((op, name, str(dtype), case, err, err <= TOLERANCES[dtype] * max(1.0, scale)))
+    return results
+
+
+def _time(fn, args, iters: int, backward: bool) -> float:
+    def run():
+        out = fn(*args)
+        if backward:
+            outs = out if isinstance(out, tuple) else (out,)
+            sum(o.float().sum() for o in outs).backward()
+
+    run()  # warmup, and compilation for the compiled backends
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        run()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - t0) / iters
+
+
+def autotune(
+    params: ModelArgs,
+    batch_size: int,
+    seqlen: int,
+    dtype=torch.float32,
+    device="cpu",
+    iters: int = 5,
+    backward: bool = False,
+) -> Dict[str, Dict[str, float]]:
+    """time every backend on the prefill shapes, select the fastest that matches eager"""
+    # a backend that fails any case is never selected
+    bad = {(op, name) for op, name, *_, ok in check(params, 1, min(seqlen, 256), (dtype,), device) if not ok}
+    timings = {}
+    for op, backends in KERNELS.items():
+        case = "causal" if op == "attention" else "prefill"
+        args = cases(op, params, batch_size, seqlen, dtype, device)[case]
+        if backward:
+            args = tuple(a.requires_grad_() if torch.is_tensor(a) and a.is_floating_point() else a for a in args)
+        timings[op] = {}
+        for name, fn in backends.items():
+            if (op, name) in bad:
+                continue
+            timings[op][name] = _time(fn, args, iters, backward)
+        set_kernels(**{op: min(timings[op], key=timings[op].get)})
+    return timings
+
+
+def configure_kernels(
+    spec: str,
+    params: ModelArgs,
+    batch_size: int,
+    seqlen: int,
+    dtype=torch.float32,
+    device="cpu",
+    backward: bool = False,
+) -> Dict[str, str]:
+    """apply a backend spec: "" keeps the defaults, "auto" benchmarks, otherwise op=backend pairs"""
+    if spec == "auto":
+        autotune(params, batch_size, seqlen, dtype, device, backward=backward)
+    elif spec:
+        set_kernels(**parse_kernels(spec))
+    return get_kernels()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check", action="store_true", help="Correctness matrix of every backend.")
+    parser.add_argument("--autotune", action="store_true", help="Benchmark and report the fastest backends.")
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--n_heads", type=int, default=12)
+    parser.add_argument("--n_kv_heads", type=int, default=0)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--seqlen", type=int, default=512)
+    parser.add_argument("--dtype", type=str, default="float32", help="float32|bfloat16|float16")
+    parser.add_argument("--backward", action="store_true", help="Time forward and backward.")
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, 0 keeps the default")
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    params = ModelArgs(dim=args.dim, n_heads=args.n_heads, n_kv_heads=args.n_kv_heads or None)
+    dtype = getattr(torch, args.dtype)
+    if args.check or not args.autotune:
+        failed = 0
+        for op, name, d, case, err, ok in check(params, seqlen=min(args.seqlen, 600), device=args.device):
+            failed += not ok
+            print(f"{op:9s} {name:9s} {d:14s} {case:13s} max err {err:.2e} {'ok' if ok else 'FAIL'}")
+        print(f"{failed} failed")
+    if args.autotune:
+        timings = autotune(params, args.batch_size, args.seqlen, dtype, args.device, backward=args.backward)
+        for op, times in timings.items():
+            line = " | ".join(f"{name} {t * 1e3:.2f}ms" for name, t in sorted(times.items(), key=lambda x: x[1]))
+            print(f"{op:9s} {line}")
+        print("selected", get_kernels())
@@ -0,0 +1,167 @@
+"""
+Serve many fine-tunes from one resident base model with low-rank adapters.
+
+A fine-tune of the pile-pretrained base (combined_sum, mediqa, per-hospital variants)
+is reduced to a rank-r adapter per projection (wq, wk, wv, wo, w1, w2, w3) by a
+truncated SVD of its weight delta. Norms and embeddings are shared with the base.
+
+$ python src/lora.py models/llama-large-pile models/llama-large-pile-combinedsum --rank=16 --out=adapters/combinedsum.pt
+
+Every adapter is stacked in the wrapped projections and each batch row picks its
+own (index 0 is the bare base), so requests for different adapters share one
+forward pass: the per-row A/B matrices are gathered and applied with two bmm calls.
+
+>>> adapters = attach_adapters(base)
+>>> adapters.add("combined_sum", torch.load("adapters/combinedsum.pt"))
+>>> engine = Engine(base, eos_id=enc.eos_id, adapters=adapters)
+>>> engine.submit(Request(tokens, adapter="combined_sum"))
+"""
+
+import argparse
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+from torch import nn
+
+# This is a very hacky and temporary solution to make this work as a standalone script
+try:
+    from src.model import Transformer
+except ImportError:
+    from model import Transformer
+
+TARGETS = [
+    "attention.wq",
+    "attention.wk",
+    "attention.wv",
+    "attention.wo",
+    "feed_forward.w1",
+    "feed_forward.w2",
+    "feed_forward.w3",
+]
+
+Adapter = Dict[str, Tuple[torch.Tensor, torch.Tensor]]  # "layers.N.attention.wq" -> (A (r, in), B (out, r))
+
+
+@torch.no_grad()
+def extract_adapter(base: Transformer, finetuned: Transformer, rank: int) -> Adapter:
+    """best rank-r approximation (truncated SVD) of every projection's fine-tuning delta"""
+    base_sd, ft_sd = base.state_dict(), finetuned.state_dict()
+    adapter = {}
+    for i in range(base.n_layers):
+        for name in TARGETS:
+            key = f"layers.{i}.{name}"
+            delta = ft_sd[key + ".weight"].float() - base_sd[key + ".weight"].float()
+            U, S, Vh = torch.linalg.svd(delta, full_matrices=False)
+            r = min(rank, S.numel())
+            adapter[key] = (Vh[:r].contiguous(), (U[:, :r] * S[:r]).contiguous())
+    return adapter
+
+
+class LoRALinear(nn.Module):
+    """a base projection plus every registered adapter, selected per batch row by AdapterSet.ids"""
+
+    def __init__(self, base: nn.Module, key: str, adapters: "AdapterSet"):
+        super().__init__()
+        self.base = base
+        self.key = key
+        self.adapters = adapters
+        out_features, in_features = base.weight.shape
+        device = base.weight.device
+        # (n_adapters, r, in) and (n_adapters, out, r), ranks zero-padded to the largest
+        self.register_buffer("lora_a", torch.zeros(1, 0, in_features, device=device), persistent=False)
+        self.register_buffer("lora_b", torch.zeros(1, out_features, 0, device=device), persistent=False)
+
+    @property
+    def weight(self) -> torch.Tensor:
+        return self.base.weight
+
+    def add(self, a: Optional[torch.Tensor], b: Optional[torch.Tensor]):
+        n, out_features, rank = self.lora_b.shape
+        r = 0 if a is None else a.size(0)
+        rank_new = max(rank, r)
+        lora_a = self.lora_a.new_zeros(n + 1, rank_new, self.lora_a.size(2))
+        lora_b = self.lora_b.new_zeros(n + 1, out_features, rank_new)
+        lora_a[:n, :rank] = self.lora_a
+        lora_b[:n, :, :rank] = self.lora_b
+        if a is not None:
+            lora_a[n, :r] = a
+            lora_b[n, :, :r] = b
+        self.lora_a, self.lora_b = lora_a, lora_b
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        y = self.base(x)
+        ids = self.adapters.ids
+        if ids is None or self.lora_a.size(1) == 0:
+            return y
+        assert ids.size(0) == x.size(0), "adapter ids are for another batch, call AdapterSet.set_batch"
+        a = self.lora_a[ids].to(x.dtype)  # (bs, r, in)
+        b = self.lora_b[ids].to(x.dtype)  # (bs, out, r)
+        return y + torch.bmm(torch.bmm(x, a.transpose(1, 2)), b.transpose(1, 2))
+
+
+class AdapterSet:
+    """the adapters loaded on a base model and the per-row selection for the next forward pass"""
+
+    def __init__(self):
+        self.index: Dict[Optional[str], int] = {None: 0}
+        self.modules: List[LoRALinear] = []
+        self.ids: Optional[torch.Tensor] = None  # (bs,) adapter index per row, None = base only
+
+    def add(self, name: str, adapter: Adapter):
+        assert name not in self.index, f"adapter {name} already loaded"
+        for module in self.modules:
+            module.add(*adapter.get(module.key, (None, None)))
+        self.index[name] = len(self.index)
+
+    def set_batch(self, names: Sequence[Optional[str]], device=None):
+        """choose the adapter of every row (None for the base) until ids is reset to None"""
+        ids = [self.index[name] for name in names]
+        self.ids = torch.tensor(ids, device=device) if any(ids) else None
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            m.lora_a.numel() * m.lora_a.element_size() + m.lora_b.numel() * m.lora_b.element_size()
+            for m in self.modules
+        )
+
+
+def attach_adapters(model: Transformer) -> AdapterSet:
+    """wrap the projections of model in place (after quantize_model if quantizing) and return the empty set"""
+    assert not model.params.fused, "adapters wrap the unfused wq/wk/wv and w1/w3 projections"
+    adapters = AdapterSet()
+    for i, layer in enumerate(model.layers):
+        for name in TARGETS:
+            parent_name, attr = name.split(".")
+            parent = getattr(layer, parent_name)
+            module = LoRALinear(getattr(parent, attr), f"layers.{i}.{name}", adapters)
+            setattr(parent, attr, module)
+            adapters.modules.append(module)
+    return adapters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("base", type=str, help="Base model directory.")
+    parser.add_argument("finetuned", type=str, help="Fine-tuned model directory.")
+    parser.add_argument("--rank", type=int, default=16)
+    parser.add_argument("--out", type=str, required=True, help="Where to torch.save the adapter.")
+    args = parser.parse_args()
+
+    base = Transformer.from_pretrained(args.base, "cpu")
+    finetuned = Transformer.from_pretrained(args.finetuned, "cpu")
+    adapter = extract_adapter(base, finetuned, args.rank)
+    torch.save(adapter, args.out)
+
+    # how much of each fine-tuning delta the adapter reproduces
+    ft_sd, base_sd = finetuned.state_dict(), base.state_dict()
+    residual, total, adapter_bytes = 0.0, 0.0, 0
+    for key, (a, b) in adapter.items():
+        delta = ft_sd[key + ".weight"].float() - base_sd[key + ".weight"].float()
+        residual += (delta - b @ a).norm().item() ** 2
+        total += delta.norm().item() ** 2
+        adapter_bytes += (a.numel() + b.numel()) * a.element_size()
+    model_bytes = sum(p.numel() * p.element_size() for p in finetuned.parameters())
+    print(
+        f"adapter {adapter_bytes / 2**20:.1f}MiB vs {model_bytes / 2**20:.1f}MiB full model | relative residual {(residual / max(total, 1e-12)) ** 0.5:.4f}"
+    )
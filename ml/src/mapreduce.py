@@ -0,0 +1,142 @@
+"""
+Hierarchical (map-reduce) summarization for transcripts longer than the context.
+
+The transcript is split into overlapping chunks of at most chunk_tokens tokens,
+every chunk is summarized as one request of the same continuous batch (map), and
+the joined partial summaries are summarized once more (reduce). If the partial
+summaries still do not fit they are chunked and mapped again. The chunks of a
+level run side by side in max_batch_size engine slots, so wall-clock time grows
+with the number of batch waves rather than the number of chunks. Example:
+
+$ python src/mapreduce.py models/llama-large-pile-combinedsum visit.txt --max_batch_size=16 --overlap=128
+"""
+
+import argparse
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+import torch
+
+# This is a very hacky and temporary solution to make this work as a standalone script
+try:
+    from src.engine import Engine, Request
+    from src.model import Transformer
+    from src.structured import Field, Skeleton
+    from src.tokenizer import Tokenizer
+except ImportError:
+    from engine import Engine, Request
+    from model import Transformer
+    from structured import Field, Skeleton
+    from tokenizer import Tokenizer
+
+
+def split_chunks(tokens: List[int], chunk_tokens: int, overlap: int) -> List[List[int]]:
+    """windows of at most chunk_tokens tokens, consecutive windows sharing overlap tokens"""
+    assert 0 <= overlap < chunk_tokens, "overlap must be smaller than the chunk"
+    step = chunk_tokens - overlap
+    return [tokens[i : i + chunk_tokens] for i in range(0, max(1, len(tokens) - overlap), step)]
+
+
+@dataclass
+class MapReduceStats:
+    chunks: int = 0  # map requests across all levels
+    levels: int = 0  # map rounds before the final reduce
+    elapsed: float = 0.0
+
+
+class MapReduceSummarizer:
+    def __init__(
+        self,
+        model: Transformer,
+        tokenizer: Tokenizer,
+        max_batch_size: int = 8,
+        chunk_tokens: Optional[int] = None,
+        overlap: int = 128,
+        map_tokens: int = 256,
+        reduce_tokens: int = 512,
+        temperature: float = 0.0,
+        header: str = "<<context>>\n",
+        footer: str = "\n\n<<summary>>\n",
+        sep: str = "\n",
+    ):
+        self.tokenizer = tokenizer
+        self.engine = Engine(
+            model, max_batch_size=max_batch_size, eos_id=tokenizer.eos_id, temperature=temperature
+        )
+        self.header = tokenizer.encode(header, bos=True, eos=False)
+        self.footer = tokenizer.encode_continuation(footer)
+        self.sep = sep
+        self.map_tokens = map_tokens
+        self.reduce_tokens = reduce_tokens
+        self.chunk_tokens = chunk_tokens or self._context_budget(map_tokens)
+        assert self.chunk_tokens <= self._context_budget(map_tokens), "chunk_tokens too large"
+        self.overlap = overlap
+        self.stats = MapReduceStats()
+
+    def _context_budget(self, max_new_tokens: int) -> int:
+        # transcript tokens that fit next to the header, footer and the response
+        return (
+            self.engine.max_seq_len - len(self.header) - len(self.footer) - max_new_tokens
+        )
+
+    def _summarize_batch(self, contexts: List[List[int]], max_new_tokens: int) -> List[str]:
+        # the summary ends at the first blank line, before the mediqa "<<topic>>" section
+        requests = [
+            Request(
+                self.header + context + self.footer,
+                max_new_tokens=max_new_tokens,
+                request_id=i,
+                skeleton=Skeleton(self.tokenizer, [Field("summary", stop="\n\n")]),
+            )
+            for i, context in enumerate(contexts)
+        ]
+        for _ in self.engine.run(requests):
+            pass
+        return [self.tokenizer.decode(r.output).strip() for r in requests]
+
+    def summarize(self, text: str) -> str:
+        t0 = time.time()
+        tokens = self.tokenizer.encode_continuation(text)
+        limit = self._context_budget(self.reduce_tokens)
+        while len(tokens) > limit:
+            chunks = split_chunks(tokens, self.chunk_tokens, self.overlap)
+            partials = self._summarize_batch(chunks, self.map_tokens)
+            self.stats.chunks += len(chunks)
+            self.stats.levels += 1
+            joined = self.tokenizer.encode_continuation(self.sep.join(partials))
+            if len(joined) >= len(tokens):
+                joined = joined[-limit:]  # the summaries did not shrink, settle for the latest
+            tokens = joined
+        summary = self._summarize_batch([tokens], self.reduce_tokens)[0]
+        self.stats.elapsed += time.time() - t0
+        return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_dir", type=str)
+    parser.add_argument("transcript", type=str, help="Text file with the transcript.")
+    parser.add_argument("--max_batch_size", type=int, default=8, help="Chunks summarized at once.")
+    parser.add_argument("--chunk_tokens", type=int, default=None)
+    parser.add_argument("--overlap", type=int, default=128)
+    parser.add_argument("--map_tokens", type=int, default=256)
+    parser.add_argument("--reduce_tokens", type=int, default=512)
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, 0 keeps the default")
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    summarizer = MapReduceSummarizer(
+        Transformer.from_pretrained(args.model_dir, args.device),
+        Tokenizer(),
+        max_batch_size=args.max_batch_size,
+        chunk_tokens=args.chunk_tokens,
+        overlap=args.overlap,
+        map_tokens=args.map_tokens,
+        reduce_tokens=args.reduce_tokens,
+    )
+    print(summarizer.summarize(open(args.transcript).read()))
+    s = summarizer.stats
+    print(f"{s.chunks} chunks over {s.levels} levels in {s.elapsed:.2f}s")
@@ -1,13 +1,16 @@
 import math
+import json
+import os
 import struct
 import inspect
 from dataclasses import dataclass
-from typing import Any, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 import apex
 
 
@@ -22,6 +25,59 @@ class ModelArgs:
     norm_eps: float = 1e-5
     max_seq_len: int = 2048
     dropout: float = 0.0
+    fused: bool = False  # one wqkv / w13 matmul instead of wq, wk, wv / w1, w3
+
+
+# kernel backends: every op has an "eager" reference implementation plus optional
+# variants, selected process-wide with set_kernels (see kernels.py to autotune them)
+KERNELS: Dict[str, Dict[str, Callable]] = {"rmsnorm": {}, "rotary": {}, "attention": {}}
+_active_kernels = {"rmsnorm": "eager", "rotary": "eager", "attention": "eager"}
+
+
+def register_kernel(op: str, name: str):
+    """decorator adding fn as the implementation called name of op"""
+
+    def register(fn):
+        KERNELS[op][name] = fn
+        return fn
+
+    return register
+
+
+def set_kernels(**choices: str):
+    """select implementations by name, e.g. set_kernels(attention="chunked")"""
+    for op, name in choices.items():
+        assert op in KERNELS, f"unknown op {op}, have {sorted(KERNELS)}"
+        assert name in KERNELS[op], f"no {op} kernel {name}, have {sorted(KERNELS[op])}"
+        _active_kernels[op] = name
+
+
+def get_kernels() -> Dict[str, str]:
+    return dict(_active_kernels)
+
+
+def kernel(op: str) -> Callable:
+    return KERNELS[op][_active_kernels[op]]
+
+
+def _compiled(fn: Callable) -> Callable:
+    """torch.compile fn on first use, so importing the model stays cheap"""
+    compiled = None
+
+    def run(*args):
+        nonlocal compiled
+        if compiled is None:
+            compiled = torch.compile(fn, dynamic=True)
+        return compiled(*args)
+
+    return run
+
+
+@register_kernel("rmsnorm", "eager")
+def rmsnorm(x: torch.Tensor, weight: torch.Tensor, eps: float) -> torch.Tensor:
+    output = x.float()
+    output = output * torch.rsqrt(output.pow(2).mean(-1, keepdim=True) + eps)
+    return output.type_as(x) * weight
 
 
 class RMSNorm(torch.nn.Module):
@@ -30,12 +86,8 @@ class RMSNorm(torch.nn.Module):
         self.eps = eps
         self.weight = nn.Parameter(torch.ones(dim))
 
-    def _norm(self, x):
-        return x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + self.eps)
-
     def forward(self, x):
-        output = self._norm(x.float()).type_as(x)
-        return output * self.weight
+        return kernel("rmsnorm")(x, self.weight, self.eps)
 
 
 def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
@@ -50,12 +102,17 @@ def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
 def reshape_for_broadcast(freqs_cis: torch.Tensor, x: torch.Tensor):
     ndim = x.ndim
     assert 0 <= 1 < ndim
+    if freqs_cis.ndim == 3:
+        # per-row positions: (bs, seqlen, head_dim // 2)
+        assert freqs_cis.shape == (x.shape[0], x.shape[1], x.shape[-1])
+        return freqs_cis.view(x.shape[0], x.shape[1], 1, x.shape[-1])
     assert freqs_cis.shape == (x.shape[1], x.shape[-1])
     shape = [d if i == 1 or i == ndim - 1 else 1 for i, d in enumerate(x.shape)]
     return freqs_cis.view(shape)
 
 
-def apply_rotary_emb(
+@register_kernel("rotary", "eager")
+def rotary_emb(
     xq: torch.Tensor, xk: torch.Tensor, freqs_cos: torch.Tensor, freqs_sin: torch.Tensor
 ) -> Tuple[torch.Tensor, torch.Tensor]:
     # reshape xq and xk to match the complex representation
@@ -79,6 +136,22 @@ def apply_rotary_emb(
     return xq_out.type_as(xq), xk_out.type_as(xk)
 
 
+def apply_rotary_emb(
+    xq: torch.Tensor, xk: torch.Tensor, freqs_cos: torch.Tensor, freqs_sin: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    return kernel("rotary")(xq, xk, freqs_cos, freqs_sin)
+
+
+def apply_rotary(x: torch.Tensor, freqs_cos: torch.Tensor, freqs_sin: torch.Tensor) -> torch.Tensor:
+    """apply_rotary_emb for a single tensor, e.g. keys and queries at different positions"""
+    x_r, x_i = x.float().reshape(x.shape[:-1] + (-1, 2)).unbind(-1)
+    freqs_cos = reshape_for_broadcast(freqs_cos, x_r)
+    freqs_sin = reshape_for_broadcast(freqs_sin, x_r)
+    x_out_r = x_r * freqs_cos - x_i * freqs_sin
+    x_out_i = x_r * freqs_sin + x_i * freqs_cos
+    return torch.stack([x_out_r, x_out_i], dim=-1).flatten(3).type_as(x)
+
+
 def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
     """torch.repeat_interleave(x, dim=2, repeats=n_rep)"""
     bs, slen, n_kv_heads, head_dim = x.shape
@@ -91,6 +164,286 @@ def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
     )
 
 
+def causal_mask(
+    start_pos: Union[int, torch.Tensor], seqlen: int, kv_len: int, device
+) -> torch.Tensor:
+    """boolean (bs or 1, 1, seqlen, kv_len) mask, True where query i may attend key j"""
+    q_pos = torch.arange(seqlen, device=device)
+    if isinstance(start_pos, int):
+        q_pos = (start_pos + q_pos)[None, :]
+    else:
+        q_pos = start_pos[:, None] + q_pos[None, :]
+    k_pos = torch.arange(kv_len, device=device)
+    return (k_pos[None, None, :] <= q_pos[:, :, None])[:, None]
+
+
+_causal_masks: Dict[torch.device, torch.Tensor] = {}
+
+
+def shared_causal_mask(seqlen: int, device) -> torch.Tensor:
+    """boolean (1, 1, seqlen, seqlen) causal mask sliced from one buffer per device, grown on demand"""
+    mask = _causal_masks.get(device)
+    if mask is None or mask.size(-1) < seqlen:
+        mask = torch.ones(seqlen, seqlen, dtype=torch.bool, device=device).tril()[None, None]
+        _causal_masks[device] = mask
+    return mask[:, :, :seqlen, :seqlen]
+
+
+def _attention_math(xq, xk, xv, mask: Optional[torch.Tensor], dropout_p: float) -> torch.Tensor:
+    scores = torch.matmul(xq, xk.transpose(2, 3)) / math.sqrt(xq.size(-1))
+    if mask is not None:
+        scores = scores.masked_fill(~mask, float("-inf"))
+    # (bs, n_local_heads, seqlen, cache_len + seqlen)
+    scores = F.softmax(scores.float(), dim=-1).type_as(xq)
+    scores = F.dropout(scores, dropout_p, training=dropout_p > 0)
+    return torch.matmul(scores, xv)  # (bs, n_local_heads, seqlen, head_dim)
+
+
+# attention kernels take (bs, n_local_heads, seqlen or kv_len, head_dim) queries, keys
+# and values, and either is_causal (seqlen == kv_len) or an optional boolean mask
+@register_kernel("attention", "eager")
+def eager_attention(xq, xk, xv, mask, is_causal: bool, dropout_p: float) -> torch.Tensor:
+    if is_causal:
+        mask = shared_causal_mask(xq.size(2), xq.device)
+    return _attention_math(xq, xk, xv, mask, dropout_p)
+
+
+@register_kernel("attention", "chunked")
+def chunked_attention(
+    xq, xk, xv, mask, is_causal: bool, dropout_p: float, chunk_size: int = 256
+) -> torch.Tensor:
+    """eager attention chunk_size queries at a time, scores are (chunk_size, kv_len) instead of (seqlen, kv_len)"""
+    seqlen = xq.size(2)
+    if is_causal:
+        mask = shared_causal_mask(seqlen, xq.device)
+    out = []
+    for i in range(0, seqlen, chunk_size):
+        # causal queries up to i + chunk_size never see the keys after them
+        end = min(i + chunk_size, seqlen) if is_causal else xk.size(2)
+        chunk_mask = None if mask is None else mask[:, :, i : i + chunk_size, :end]
+        out.append(
+            _attention_math(xq[:, :, i : i + chunk_size], xk[:, :, :end], xv[:, :, :end], chunk_mask, dropout_p)
+        )
+    return torch.cat(out, dim=2)
+
+
+if hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+
+    @register_kernel("attention", "sdpa")
+    def sdpa_attention(xq, xk, xv, mask, is_causal: bool, dropout_p: float) -> torch.Tensor:
+        return F.scaled_dot_product_attention(
+            xq, xk, xv, attn_mask=mask, dropout_p=dropout_p, is_causal=is_causal
+        )
+
+    _active_kernels["attention"] = "sdpa"
+
+if hasattr(torch, "compile"):
+    register_kernel("rmsnorm", "compiled")(_compiled(rmsnorm))
+    register_kernel("rotary", "compiled")(_compiled(rotary_emb))
+    _attention_math_compiled = _compiled(_attention_math)
+
+    @register_kernel("attention", "compiled")
+    def compiled_attention(xq, xk, xv, mask, is_causal: bool, dropout_p: float) -> torch.Tensor:
+        if is_causal:
+            mask = shared_causal_mask(xq.size(2), xq.device)
+        return _attention_math_compiled(xq, xk, xv, mask, dropout_p)
+
+
+class KVCache(nn.Module):
+    """
+    Contiguous key/value cache for one attention layer, preallocated to
+    (max_batch_size, max_seq_len). start_pos is either an int shared by the whole
+    batch or a LongTensor of shape (bs,) with one offset per row.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int,
+        max_seq_len: int,
+        n_kv_heads: int,
+        head_dim: int,
+        dtype: torch.dtype = torch.float32,
+    ):
+        super().__init__()
+        self.max_seq_len = max_seq_len
+        shape = (max_batch_size, max_seq_len, n_kv_heads, head_dim)
+        self.register_buffer("cache_k", torch.zeros(shape, dtype=dtype), persistent=False)
+        self.register_buffer("cache_v", torch.zeros(shape, dtype=dtype), persistent=False)
+
+    def update(
+        self,
+        start_pos: Union[int, torch.Tensor],
+        xk: torch.Tensor,
+        xv: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
+        """
+        Write xk/xv (bs, seqlen, n_kv_heads, head_dim) at start_pos and return the
+        keys, values and attention mask covering everything cached so far.
+        A mask of None means every query may attend every returned key.
+        """
+        bsz, seqlen = xk.shape[:2]
+        if isinstance(start_pos, int):
+            end = start_pos + seqlen
+            assert end <= self.max_seq_len, "kv cache overflow"
+            self._store((slice(0, bsz), slice(start_pos, end)), xk, xv)
+            mask = None if seqlen == 1 else causal_mask(start_pos, seqlen, end, xk.device)
+        else:
+            # ragged rows: real tokens always fit, positions past max_seq_len only hold
+            # right padding. Those writes are dropped, clamping them into the last slot
+            # would race with a real token written there in the same call
+            pos = start_pos[:, None] + torch.arange(seqlen, device=xk.device)[None, :]
+            rows = torch.arange(bsz, device=xk.device)[:, None].expand_as(pos)
+            keep = pos < self.max_seq_len
+            self._store((rows[keep], pos[keep]), xk[keep], xv[keep])
+            end = min(int(start_pos.max()) + seqlen, self.max_seq_len)
+            mask = causal_mask(start_pos, seqlen, end, xk.device)
+        keys, values = self._load((slice(0, bsz), slice(0, end)))
+        return keys, values, mask
+
+    def _store(self, index, xk: torch.Tensor, xv: torch.Tensor):
+        self.cache_k[index] = xk.to(self.cache_k.dtype)
+        self.cache_v[index] = xv.to(self.cache_v.dtype)
+
+    def _load(self, index) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.cache_k[index], self.cache_v[index]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(b.numel() * b.element_size() for b in self.buffers())
+
+    def read(self, row: int, length: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """copy out the first length positions of one batch row"""
+        k, v = self._load((row, slice(0, length)))
+        return k.clone(), v.clone()
+
+    def write(self, row: int, k: torch.Tensor, v: torch.Tensor):
+        """load (length, n_kv_heads, head_dim) keys/values into one batch row from position 0"""
+        self._store((row, slice(0, k.size(0))), k, v)
+
+
+def quantize_heads(x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """symmetric int8 quantization of (..., head_dim) vectors, one fp16 absmax scale per vector"""
+    x = x.float()
+    scales = (x.abs().amax(dim=-1) / 127.0).clamp(min=1e-8)
+    q = torch.round(x / scales[..., None]).clamp(-127, 127).to(torch.int8)
+    return q, scales.half()
+
+
+class Int8KVCache(KVCache):
+    """
+    KVCache storing keys/values as int8 with one scale per (row, position, head),
+    dequantized to dtype when read. Close to 4x smaller than fp32 (2x vs fp16),
+    the scales add 2 bytes per head_dim values.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int,
+        max_seq_len: int,
+        n_kv_heads: int,
+        head_dim: int,
+        dtype: torch.dtype = torch.float32,
+    ):
+        super().__init__(max_batch_size, max_seq_len, n_kv_heads, head_dim, torch.int8)
+        self.dtype = dtype
+        shape = (max_batch_size, max_seq_len, n_kv_heads)
+        self.register_buffer("scales_k", torch.zeros(shape, dtype=torch.half), persistent=False)
+        self.register_buffer("scales_v", torch.zeros(shape, dtype=torch.half), persistent=False)
+
+    def _store(self, index, xk: torch.Tensor, xv: torch.Tensor):
+        self.cache_k[index], self.scales_k[index] = quantize_heads(xk)
+        self.cache_v[index], self.scales_v[index] = quantize_heads(xv)
+
+    def _load(self, index) -> Tuple[torch.Tensor, torch.Tensor]:
+        keys = self.cache_k[index].to(self.dtype) * self.scales_k[index][..., None].to(self.dtype)
+        values = self.cache_v[index].to(self.dtype) * self.scales_v[index][..., None].to(self.dtype)
+        return keys, values
+
+
+class RollingKVCache(nn.Module):
+    """
+    Constant-size cache for inputs longer than max_seq_len (StreamingLLM): keeps the
+    first n_sink "attention sink" tokens plus the most recent window tokens. Keys are
+    stored before RoPE and rotated by their index inside the cache on every read, so
+    positions never run past the precomputed freqs_cos/freqs_sin. Chunks appended in
+    one call must be at most window tokens long; the earliest queries of a chunk then
+    see a slightly shorter recent window.
+    """
+
+    # Attention hands this cache un-rotated queries/keys and lets it apply RoPE
+    rotary = True
+
+    def __init__(
+        self,
+        max_batch_size: int,
+        n_sink: int,
+        window: int,
+        n_kv_heads: int,
+        head_dim: int,
+        freqs_cos: torch.Tensor,
+        freqs_sin: torch.Tensor,
+        dtype: torch.dtype = torch.float32,
+    ):
+        super().__init__()
+        assert n_sink + window <= freqs_cos.size(0), "sinks + window must fit in max_seq_len"
+        self.n_sink = n_sink
+        self.window = window
+        self.length = 0  # tokens currently held, the same for every row
+        shape = (max_batch_size, n_sink + window, n_kv_heads, head_dim)
+        self.register_buffer("cache_k", torch.zeros(shape, dtype=dtype), persistent=False)
+        self.register_buffer("cache_v", torch.zeros(shape, dtype=dtype), persistent=False)
+        self.register_buffer("freqs_cos", freqs_cos, persistent=False)
+        self.register_buffer("freqs_sin", freqs_sin, persistent=False)
+
+    def update_rotary(
+        self,
+        start_pos: int,
+        xq: torch.Tensor,
+        xk: torch.Tensor,
+        xv: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
+        """append un-rotated xk/xv, returns rotated queries, rotated keys, values and mask"""
+        assert isinstance(start_pos, int), "rolling caches only support a shared start_pos"
+        bsz, seqlen = xk.shape[:2]
+        assert seqlen <= self.window, "feed long prompts in chunks of at most window tokens"
+        keys = torch.cat((self.cache_k[:bsz, : self.length], xk.to(self.cache_k.dtype)), dim=1)
+        values = torch.cat((self.cache_v[:bsz, : self.length], xv.to(self.cache_v.dtype)), dim=1)
+        if keys.size(1) > self.n_sink + self.window:
+            # evict the oldest non-sink tokens and close the gap
+            keys = torch.cat((keys[:, : self.n_sink], keys[:, -self.window :]), dim=1)
+            values = torch.cat((values[:, : self.n_sink], values[:, -self.window :]), dim=1)
+        self.length = keys.size(1)
+        self.cache_k[:bsz, : self.length] = keys
+        self.cache_v[:bsz, : self.length] = values
+
+        # re-base RoPE: positions are indices inside the cache, queries are the last seqlen
+        q_start = self.length - seqlen
+        xq = apply_rotary(xq, self.freqs_cos[q_start : self.length], self.freqs_sin[q_start : self.length])
+        keys = apply_rotary(keys, self.freqs_cos[: self.length], self.freqs_sin[: self.length])
+        mask = None if seqlen == 1 else causal_mask(q_start, seqlen, self.length, xk.device)
+        return xq, keys, values, mask
+
+
+def fuse_linears(module: nn.Module, fused: str, parts: List[str], sizes: List[int]):
+    """
+    Keep checkpoints in the unfused layout: the weight of module.<fused> is written
+    as one <part>.weight per part in state_dict() and rebuilt from them on load.
+    """
+
+    def split(module, state_dict, prefix, local_metadata):
+        weight = state_dict.pop(prefix + fused + ".weight")
+        for name, w in zip(parts, weight.split(sizes, dim=0)):
+            state_dict[prefix + name + ".weight"] = w
+
+    def join(state_dict, prefix, *args):
+        keys = [prefix + name + ".weight" for name in parts]
+        if all(k in state_dict for k in keys):
+            state_dict[prefix + fused + ".weight"] = torch.cat([state_dict.pop(k) for k in keys])
+
+    module._register_state_dict_hook(split)
+    module._register_load_state_dict_pre_hook(join)
+
+
 class Attention(nn.Module):
     def __init__(self, args: ModelArgs):
         super().__init__()
@@ -100,40 +453,62 @@ class Attention(nn.Module):
         self.n_local_kv_heads = self.n_kv_heads // model_parallel_size
         self.n_rep = self.n_local_heads // self.n_local_kv_heads
         self.head_dim = args.dim // args.n_heads
-        self.wq = nn.Linear(args.dim, args.n_heads * self.head_dim, bias=False)
-        self.wk = nn.Linear(args.dim, self.n_kv_heads * self.head_dim, bias=False)
-        self.wv = nn.Linear(args.dim, self.n_kv_heads * self.head_dim, bias=False)
+        self.fused = args.fused
+        self.qkv_sizes = [
+            args.n_heads * self.head_dim,
+            self.n_kv_heads * self.head_dim,
+            self.n_kv_heads * self.head_dim,
+        ]
+        if self.fused:
+            self.wqkv = nn.Linear(args.dim, sum(self.qkv_sizes), bias=False)
+            fuse_linears(self, "wqkv", ["wq", "wk", "wv"], self.qkv_sizes)
+        else:
+            self.wq = nn.Linear(args.dim, self.qkv_sizes[0], bias=False)
+            self.wk = nn.Linear(args.dim, self.qkv_sizes[1], bias=False)
+            self.wv = nn.Linear(args.dim, self.qkv_sizes[2], bias=False)
         self.wo = nn.Linear(args.n_heads * self.head_dim, args.dim, bias=False)
-        self.attn_dropout = nn.Dropout(args.dropout)
         self.resid_dropout = nn.Dropout(args.dropout)
         self.dropout = args.dropout
+        # set by Transformer.setup_caches for incremental decoding
+        self.cache: Optional[KVCache] = None
 
-        # use flash attention or a manual implementation?
-        self.flash = hasattr(torch.nn.functional, "scaled_dot_product_attention")
-        if not self.flash:
+        if "sdpa" not in KERNELS["attention"]:
             print(
                 "WARNING: using slow attention. Flash Attention requires PyTorch >= 2.0"
             )
-            mask = torch.full((1, 1, args.max_seq_len, args.max_seq_len), float("-inf"))
-            mask = torch.triu(mask, diagonal=1)
-            self.register_buffer("mask", mask)
 
     def forward(
         self,
         x: torch.Tensor,
         freqs_cos: torch.Tensor,
         freqs_sin: torch.Tensor,
+        start_pos: Optional[Union[int, torch.Tensor]] = None,
     ):
         bsz, seqlen, _ = x.shape
 
         # QKV
-        xq, xk, xv = self.wq(x), self.wk(x), self.wv(x)
+        if self.fused:
+            xq, xk, xv = self.wqkv(x).split(self.qkv_sizes, dim=-1)
+        else:
+            xq, xk, xv = self.wq(x), self.wk(x), self.wv(x)
         xq = xq.view(bsz, seqlen, self.n_local_heads, self.head_dim)
         xk = xk.view(bsz, seqlen, self.n_local_kv_heads, self.head_dim)
         xv = xv.view(bsz, seqlen, self.n_local_kv_heads, self.head_dim)
 
-        # RoPE relative positional embeddings
-        xq, xk = apply_rotary_emb(xq, xk, freqs_cos, freqs_sin)
+        mask = None
+        if start_pos is not None and getattr(self.cache, "rotary", False):
+            # rolling cache: RoPE positions are re-based inside the cache
+            xq, xk, xv, mask = self.cache.update_rotary(start_pos, xq, xk, xv)
+            xk, xv = xk.to(xq.dtype), xv.to(xq.dtype)
+        else:
+            # RoPE relative positional embeddings
+            xq, xk = apply_rotary_emb(xq, xk, freqs_cos, freqs_sin)
+
+            # incremental decoding: attend over everything in the kv cache
+            if start_pos is not None:
+                assert self.cache is not None, "call Transformer.setup_caches first"
+                xk, xv, mask = self.cache.update(start_pos, xk, xv)
+                xk, xv = xk.to(xq.dtype), xv.to(xq.dtype)
 
         # grouped multiquery attention: expand out keys and values
         xk = repeat_kv(xk, self.n_rep)  # (bs, seqlen, n_local_heads, head_dim)
@@ -144,26 +519,17 @@ class Attention(nn.Module):
         xk = xk.transpose(1, 2)
         xv = xv.transpose(1, 2)
 
-        # flash implementation
-        if self.flash:
-            output = torch.nn.functional.scaled_dot_product_attention(
-                xq,
-                xk,
-                xv,
-                attn_mask=None,
-                dropout_p=self.dropout if self.training else 0.0,
-                is_causal=True,
-            )
-        else:
-            # manual implementation
-            scores = torch.matmul(xq, xk.transpose(2, 3)) / math.sqrt(self.head_dim)
-            assert hasattr(self, "mask")
-            scores = (
-                scores + self.mask[:, :, :seqlen, :seqlen]
-            )  # (bs, n_local_heads, seqlen, cache_len + seqlen)
-            scores = F.softmax(scores.float(), dim=-1).type_as(xq)
-            scores = self.attn_dropout(scores)
-            output = torch.matmul(scores, xv)  # (bs, n_local_heads, seqlen, head_dim)
+        # flash (sdpa), eager or chunked implementation, see KERNELS
+        # without a cache (or on a fresh prefill) plain causal masking is enough
+        is_causal = start_pos is None or (mask is not None and xk.size(2) == seqlen)
+        output = kernel("attention")(
+            xq,
+            xk,
+            xv,
+            None if is_causal else mask,
+            is_causal,
+            self.dropout if self.training else 0.0,
+        )
 
         # restore time as batch dimension and concat heads
         output = output.transpose(1, 2).contiguous().view(bsz, seqlen, -1)
@@ -175,17 +541,28 @@ class Attention(nn.Module):
 
 
 class FeedForward(nn.Module):
-    def __init__(self, dim: int, hidden_dim: int, multiple_of: int, dropout: float):
+    def __init__(
+        self, dim: int, hidden_dim: int, multiple_of: int, dropout: float, fused: bool = False
+    ):
         super().__init__()
         hidden_dim = int(2 * hidden_dim / 3)
         hidden_dim = multiple_of * ((hidden_dim + multiple_of - 1) // multiple_of)
-        self.w1 = nn.Linear(dim, hidden_dim, bias=False)
+        self.fused = fused
+        if fused:
+            self.w13 = nn.Linear(dim, 2 * hidden_dim, bias=False)
+            fuse_linears(self, "w13", ["w1", "w3"], [hidden_dim, hidden_dim])
+        else:
+            self.w1 = nn.Linear(dim, hidden_dim, bias=False)
+            self.w3 = nn.Linear(dim, hidden_dim, bias=False)
         self.w2 = nn.Linear(hidden_dim, dim, bias=False)
-        self.w3 = nn.Linear(dim, hidden_dim, bias=False)
         self.dropout = nn.Dropout(dropout)
 
     def forward(self, x):
-        return self.dropout(self.w2(F.silu(self.w1(x)) * self.w3(x)))
+        if self.fused:
+            x1, x3 = self.w13(x).chunk(2, dim=-1)
+        else:
+            x1, x3 = self.w1(x), self.w3(x)
+        return self.dropout(self.w2(F.silu(x1) * x3))
 
 
 class TransformerBlock(nn.Module):
@@ -200,17 +577,107 @@ class TransformerBlock(nn.Module):
             hidden_dim=4 * args.dim,
             multiple_of=args.multiple_of,
             dropout=args.dropout,
+            fused=args.fused,
         )
         self.layer_id = layer_id
         self.attention_norm = RMSNorm(args.dim, eps=args.norm_eps)
         self.ffn_norm = RMSNorm(args.dim, eps=args.norm_eps)
+        # "block" | "attention" | None, set by Transformer.set_activation_checkpointing
+        self.checkpoint: Optional[str] = None
+
+    def _attention(self, x, freqs_cos, freqs_sin, start_pos=None):
+        return self.attention(self.attention_norm(x), freqs_cos, freqs_sin, start_pos)
+
+    def _block(self, x, freqs_cos, freqs_sin, start_pos=None):
+        h = x + self._attention(x, freqs_cos, freqs_sin, start_pos)
+        out = h + self.feed_forward(self.ffn_norm(h))
+        return out
 
-    def forward(self, x, freqs_cos, freqs_sin):
-        h = x + self.attention.forward(self.attention_norm(x), freqs_cos, freqs_sin)
-        out = h + self.feed_forward.forward(self.ffn_norm(h))
+    def forward(self, x, freqs_cos, freqs_sin, start_pos=None):
+        if self.checkpoint is None or not (self.training and torch.is_grad_enabled()):
+            return self._block(x, freqs_cos, freqs_sin, start_pos)
+        # non-reentrant checkpointing works under torch.compile and DDP
+        if self.checkpoint == "block":
+            # only the block input is kept, everything inside is recomputed in backward
+            return checkpoint(self._block, x, freqs_cos, freqs_sin, start_pos, use_reentrant=False)
+        h = x + checkpoint(self._attention, x, freqs_cos, freqs_sin, start_pos, use_reentrant=False)
+        out = h + self.feed_forward(self.ffn_norm(h))
         return out
 
 
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """
+    Mean cross-entropy (ignore_index=-1) of the logits h @ weight.T, computed
+    chunk_size rows at a time. Only one chunk of logits exists at any point: the
+    forward keeps the per-row logsumexp and the backward recomputes each chunk's
+    logits (in the dtype the forward used, e.g. under autocast) to form
+    softmax - onehot. Peak logits memory drops from rows * vocab_size to
+    chunk_size * vocab_size, e.g. 8 x 2048 x 32000 bf16 logits plus their fp32
+    softmax copies (~3GB) become ~0.3GB at chunk_size=2048.
+    """
+
+    @staticmethod
+    def forward(ctx, h, weight, targets, chunk_size):
+        valid = targets != -1
+        n_valid = valid.sum().clamp(min=1)
+        lse = torch.empty(h.size(0), dtype=torch.float32, device=h.device)
+        loss = torch.zeros((), dtype=torch.float32, device=h.device)
+        dtype = h.dtype
+        for i in range(0, h.size(0), chunk_size):
+            logits = F.linear(h[i : i + chunk_size], weight)
+            dtype = logits.dtype
+            logits = logits.float()
+            lse[i : i + chunk_size] = torch.logsumexp(logits, dim=-1)
+            t = targets[i : i + chunk_size]
+            picked = logits.gather(1, t.clamp(min=0)[:, None])[:, 0]
+            loss += ((lse[i : i + chunk_size] - picked) * valid[i : i + chunk_size]).sum()
+        ctx.save_for_backward(h, weight, targets, lse, n_valid)
+        ctx.chunk_size = chunk_size
+        ctx.dtype = dtype
+        return loss / n_valid
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        h, weight, targets, lse, n_valid = ctx.saved_tensors
+        w = weight.to(ctx.dtype)
+        grad_h = torch.empty_like(h)
+        grad_w = torch.zeros(weight.shape, dtype=torch.float32, device=weight.device)
+        scale = grad_output / n_valid
+        for i in range(0, h.size(0), ctx.chunk_size):
+            hc = h[i : i + ctx.chunk_size].to(ctx.dtype)
+            t = targets[i : i + ctx.chunk_size]
+            # d loss / d logits = (softmax - onehot) / n_valid, zero on ignored rows
+            grad = torch.exp(F.linear(hc, w).float() - lse[i : i + ctx.chunk_size, None])
+            grad[torch.arange(t.size(0), device=t.device), t.clamp(min=0)] -= 1.0
+            grad = (grad * ((t != -1)[:, None] * scale)).to(ctx.dtype)
+            grad_h[i : i + ctx.chunk_size] = grad @ w
+            grad_w += (grad.t() @ hc).float()
+        return grad_h, grad_w.to(weight.dtype), None, None
+
+
+def sample(logits: torch.Tensor, temperature: float = 1.0, top_k: Optional[int] = None):
+    """pick the next index for every row of (b, vocab_size) logits, returns (b, 1)"""
+    if temperature == 0.0:
+        # "sample" the single most likely index
+        _, idx_next = torch.topk(logits, k=1, dim=-1)
+        return idx_next
+    # pluck the logits at the final step and scale by desired temperature
+    logits = logits / temperature
+    # optionally crop the logits to only the top k options
+    if top_k is not None:
+        v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+        logits[logits < v[:, [-1]]] = -float("Inf")
+    # apply softmax to convert logits to (normalized) probabilities
+    probs = F.softmax(logits, dim=-1)
+    return torch.multinomial(probs, num_samples=1)
+
+
+def model_bytes(model: nn.Module) -> int:
+    """memory held by parameters and buffers, tied or shared tensors counted once"""
+    tensors = {t.data_ptr(): t for t in list(model.parameters()) + list(model.buffers())}
+    return sum(t.numel() * t.element_size() for t in tensors.values())
+
+
 class Transformer(nn.Module):
     last_loss: Optional[torch.Tensor]
 
@@ -248,9 +715,16 @@ class Transformer(nn.Module):
                 torch.nn.init.normal_(
                     p, mean=0.0, std=0.02 / math.sqrt(2 * params.n_layers)
                 )
+            elif pn.endswith("w13.weight"):
+                # the w3 half of the fused projection
+                torch.nn.init.normal_(
+                    p[p.size(0) // 2 :], mean=0.0, std=0.02 / math.sqrt(2 * params.n_layers)
+                )
 
         # Initialize attribute for the loss of the last forward call. This will be set if the forward is called with a targets tensor.
         self.last_loss = None
+        # rows of logits per chunk of the training loss, 0 materializes all the logits at once
+        self.loss_chunk_size = 0
 
     def _init_weights(self, module):
         if isinstance(module, nn.Linear):
@@ -260,25 +734,120 @@ class Transformer(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
+    def set_activation_checkpointing(self, policy: str = "none", every: int = 1):
+        """
+        Trade recompute for activation memory in training: "block" recomputes whole
+        blocks, "attention" only the attention sublayers, on every k-th block.
+        """
+        assert policy in ("none", "block", "attention"), f"unknown policy {policy}"
+        assert every >= 1
+        for i, layer in enumerate(self.layers):
+            layer.checkpoint = None if policy == "none" or i % every != 0 else policy
+
+    def setup_caches(
+        self,
+        max_batch_size: int,
+        max_seq_len: Optional[int] = None,
+        dtype=None,
+        kv_int8: bool = False,
+    ):
+        """allocate a fresh key/value cache in every attention layer, stored as int8 if kv_int8"""
+        max_seq_len = min(max_seq_len or self.params.max_seq_len, self.params.max_seq_len)
+        dtype = dtype or self.norm.weight.dtype
+        device = self.norm.weight.device
+        cache_cls = Int8KVCache if kv_int8 else KVCache
+        for layer in self.layers:
+            attn = layer.attention
+            attn.cache = cache_cls(
+                max_batch_size, max_seq_len, attn.n_local_kv_heads, attn.head_dim, dtype
+            ).to(device)
+
+    def setup_rolling_caches(self, max_batch_size: int, n_sink: int = 4, window: Optional[int] = None, dtype=None):
+        """allocate constant-size attention-sink caches, window defaults to max_seq_len - n_sink"""
+        window = window or self.params.max_seq_len - n_sink
+        dtype = dtype or self.norm.weight.dtype
+        device = self.norm.weight.device
+        for layer in self.layers:
+            attn = layer.attention
+            attn.cache = RollingKVCache(
+                max_batch_size,
+                n_sink,
+                window,
+                attn.n_local_kv_heads,
+                attn.head_dim,
+                self.freqs_cos,
+                self.freqs_sin,
+                dtype,
+            ).to(device)
+
+    def reset_caches(self):
+        """drop the key/value caches and free their memory"""
+        for layer in self.layers:
+            layer.attention.cache = None
+
+    def read_kv(self, row: int, length: int):
+        """per-layer (keys, values) of the first length cached positions of one batch row"""
+        return [layer.attention.cache.read(row, length) for layer in self.layers]
+
+    def write_kv(self, row: int, kv):
+        """load per-layer (keys, values) from read_kv into one batch row of the caches"""
+        for layer, (k, v) in zip(self.layers, kv):
+            layer.attention.cache.write(row, k, v)
+
     def forward(
-        self, tokens: torch.Tensor, targets: Optional[torch.Tensor] = None
+        self,
+        tokens: torch.Tensor,
+        targets: Optional[torch.Tensor] = None,
+        start_pos: Optional[Union[int, torch.Tensor]] = None,
+        seqlens: Optional[torch.Tensor] = None,
+        all_logits: bool = False,
     ) -> torch.Tensor:
+        """
+        With start_pos=None this is the usual full-sequence forward. Otherwise tokens
+        are appended to the kv caches at position start_pos (an int, or a LongTensor
+        of per-row offsets) and only attend to what is already cached.
+        For right-padded batches, seqlens (bs,) holds the number of real tokens per
+        row and the logits are taken at each row's last real token.
+        all_logits=True returns logits for every position, e.g. to verify drafted tokens.
+        """
         _bsz, seqlen = tokens.shape
         h = self.tok_embeddings(tokens)
         h = self.dropout(h)
-        freqs_cos = self.freqs_cos[:seqlen]
-        freqs_sin = self.freqs_sin[:seqlen]
+        if start_pos is None:
+            freqs_cos = self.freqs_cos[:seqlen]
+            freqs_sin = self.freqs_sin[:seqlen]
+        elif isinstance(start_pos, int):
+            # (rolling caches ignore these and may run past the end of the table)
+            freqs_cos = self.freqs_cos[start_pos : start_pos + seqlen]
+            freqs_sin = self.freqs_sin[start_pos : start_pos + seqlen]
+        else:
+            pos = start_pos[:, None] + torch.arange(seqlen, device=tokens.device)
+            pos = pos.clamp(max=self.params.max_seq_len - 1)
+            freqs_cos = self.freqs_cos[pos]
+            freqs_sin = self.freqs_sin[pos]
 
         for layer in self.layers:
-            h = layer(h, freqs_cos, freqs_sin)
+            h = layer(h, freqs_cos, freqs_sin, start_pos)
         h = self.norm(h)
 
-        if targets is not None:
+        if targets is not None and self.loss_chunk_size > 0:
+            # same loss without ever holding the full (bsz, seqlen, vocab_size) logits
+            logits = None
+            self.last_loss = ChunkedCrossEntropy.apply(
+                h.view(-1, h.size(-1)), self.output.weight, targets.view(-1), self.loss_chunk_size
+            )
+        elif targets is not None:
             # if we are given some desired targets also calculate the loss
             logits = self.output(h)
             self.last_loss = F.cross_entropy(
                 logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1
             )
+        elif all_logits:
+            logits = self.output(h)
+            self.last_loss = None
+        elif seqlens is not None:
+            logits = self.output(h[torch.arange(_bsz, device=h.device), seqlens - 1][:, None, :])
+            self.last_loss = None
         else:
             # inference-time mini-optimization: only forward the output on the very last position
             logits = self.output(
@@ -345,41 +914,122 @@ class Transformer(nn.Module):
         return mfu
 
     @torch.inference_mode()
-    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None):
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, attention_sinks=0):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
-        Also note this is a super inefficient version of sampling with no key/value cache.
+        The prompt is prefilled into a key/value cache once, after which every new token
+        costs a single-position forward pass.
+        With attention_sinks > 0 nothing is cropped: the whole prompt streams through a
+        rolling cache holding those first tokens plus the most recent ones, at constant
+        memory and per-token cost however long the input is.
         """
-        for _ in range(max_new_tokens):
+        max_seq_len = self.params.max_seq_len
+        if attention_sinks > 0:
+            self.setup_rolling_caches(idx.size(0), attention_sinks)
+            chunk = min(512, max_seq_len - attention_sinks)
+            for s in range(0, idx.size(1), chunk):
+                logits = self(idx[:, s : s + chunk], start_pos=s)
+            start_pos = idx.size(1)
+            max_seq_len = float("inf")  # the rolling cache never fills up
+        else:
+            self.setup_caches(idx.size(0), idx.size(1) + max_new_tokens)
             # if the sequence context is growing too long we must crop it at block_size
-            idx_cond = (
-                idx
-                if idx.size(1) <= self.params.max_seq_len
-                else idx[:, -self.params.max_seq_len :]
-            )
-            # forward the model to get the logits for the index in the sequence
-            logits, _ = self(idx_cond)
-            logits = logits[:, -1, :]  # crop to just the final time step
-            if temperature == 0.0:
-                # "sample" the single most likely index
-                _, idx_next = torch.topk(logits, k=1, dim=-1)
-            else:
-                # pluck the logits at the final step and scale by desired temperature
-                logits = logits / temperature
-                # optionally crop the logits to only the top k options
-                if top_k is not None:
-                    v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                    logits[logits < v[:, [-1]]] = -float("Inf")
-                # apply softmax to convert logits to (normalized) probabilities
-                probs = F.softmax(logits, dim=-1)
-                idx_next = torch.multinomial(probs, num_samples=1)
+            idx_cond = idx if idx.size(1) <= max_seq_len else idx[:, -max_seq_len:]
+            logits = self(idx_cond, start_pos=0)
+            start_pos = idx_cond.size(1)
+        for i in range(max_new_tokens):
+            # crop to just the final time step
+            idx_next = sample(logits[:, -1, :], temperature, top_k)
             # append sampled index to the running sequence and continue
             idx = torch.cat((idx, idx_next), dim=1)
+            if i == max_new_tokens - 1:
+                break
+            if start_pos < max_seq_len:
+                # forward only the new token, everything before it is cached
+                logits = self(idx_next, start_pos=start_pos)
+                start_pos += 1
+            else:
+                # the cache is full: slide the window by re-prefilling the cropped context
+                logits = self(idx[:, -max_seq_len:], start_pos=0)
 
+        self.reset_caches()
         return idx
 
+    @torch.inference_mode()
+    def score_labels(self, prefix: torch.Tensor, labels: List[List[int]]) -> torch.Tensor:
+        """
+        Log-probability of each candidate continuation in labels (lists of token ids) after
+        a shared prefix (LongTensor of shape (t,)), e.g. every topic of a closed set after
+        the transcript. The prefix is prefilled once, its cache is shared by all labels,
+        and the labels are scored together in a single batched forward pass.
+        End each label with eos so that a label cannot win by being a prefix of another.
+        """
+        n, longest = len(labels), max(len(label) for label in labels)
+        assert min(len(label) for label in labels) > 0, "empty label"
+        prefix = prefix[-(self.params.max_seq_len - longest) :]
+        prefix_len = prefix.size(0)
+        self.setup_caches(n, prefix_len + longest)
+        # next-token logits after the prefix, they predict every label's first token
+        logits = self(prefix[None], start_pos=0)
+        kv = self.read_kv(0, prefix_len)
+        for row in range(1, n):
+            self.write_kv(row, kv)
+
+        tokens = torch.zeros((n, longest), dtype=torch.long, device=prefix.device)
+        lengths = torch.tensor([len(label) for label in labels], device=prefix.device)
+        for j, label in enumerate(labels):
+            tokens[j, : len(label)] = torch.tensor(label, dtype=torch.long)
+        label_logits = self(tokens, start_pos=prefix_len, all_logits=True)
+        # label position t predicts label token t + 1, the last position predicts nothing
+        logits = torch.cat((logits.expand(n, 1, -1), label_logits[:, :-1]), dim=1)
+        logprobs = F.log_softmax(logits.float(), dim=-1).gather(-1, tokens[..., None])[..., 0]
+        mask = torch.arange(longest, device=prefix.device)[None, :] < lengths[:, None]
+        self.reset_caches()
+        return (logprobs * mask).sum(dim=-1)
+
+    @classmethod
+    def from_pretrained(cls, model_dir: str, device="cpu", fused: bool = False) -> "Transformer":
+        """
+        Rebuild a model from a train.py output directory: weights from ckpt.pt and
+        shapes from the config.json written by save_as_hf, falling back to the
+        model_args stored in resume.pt_ckpt. fused loads into the wqkv / w13 layout.
+        """
+        config_path = os.path.join(model_dir, "config.json")
+        ckpt_path = os.path.join(model_dir, "ckpt.pt")
+        if os.path.exists(config_path) and os.path.exists(ckpt_path):
+            state_dict = torch.load(ckpt_path, map_location=device)
+            config = json.load(open(config_path))
+            hidden_dim = state_dict["layers.0.feed_forward.w1.weight"].shape[0]
+            model_args = dict(
+                dim=config["hidden_size"],
+                n_layers=config["num_hidden_layers"],
+                n_heads=config["num_attention_heads"],
+                n_kv_heads=config.get("num_key_value_heads"),
+                vocab_size=state_dict["tok_embeddings.weight"].shape[0],
+                # any multiple_of that rounds up to the stored hidden size rebuilds the same FeedForward
+                multiple_of=hidden_dim,
+                max_seq_len=config["max_position_embeddings"],
+            )
+        else:
+            checkpoint = torch.load(
+                os.path.join(model_dir, "resume.pt_ckpt"), map_location=device
+            )
+            state_dict = checkpoint["model"]
+            model_args = checkpoint["model_args"]
+        unwanted_prefix = "_orig_mod."
+        for k in list(state_dict.keys()):
+            if k.startswith(unwanted_prefix):
+                state_dict[k[len(unwanted_prefix) :]] = state_dict.pop(k)
+        model_args["dropout"] = 0.0
+        model_args["fused"] = fused
+        model = cls(ModelArgs(**model_args))
+        model.load_state_dict(state_dict)
+        model.to(device)
+        model.eval()
+        return model
+
     def export(self, filepath="model.bin"):
         """export the model weights in fp32 into .bin file to be read from C"""
         f = open(filepath, "wb")
@@ -389,8 +1039,11 @@ class Transformer(nn.Module):
             b = struct.pack(f"{len(d)}f", *d)
             f.write(b)
 
+        # projections are read through the state dict, which is unfused in either layout
+        sd = self.state_dict()
+
         # first write out the header
-        hidden_dim = self.layers[0].feed_forward.w1.weight.shape[0]
+        hidden_dim = sd["layers.0.feed_forward.w1.weight"].shape[0]
         p = self.params
         n_kv_heads = p.n_heads if p.n_kv_heads is None else p.n_kv_heads
         header = struct.pack(
@@ -412,23 +1065,23 @@ class Transformer(nn.Module):
         # attention weights
         for layer in self.layers:
             serialize(layer.attention_norm.weight)
-        for layer in self.layers:
-            serialize(layer.attention.wq.weight)
-        for layer in self.layers:
-            serialize(layer.attention.wk.weight)
-        for layer in self.layers:
-            serialize(layer.attention.wv.weight)
+        for i in range(p.n_layers):
+            serialize(sd[f"layers.{i}.attention.wq.weight"])
+        for i in range(p.n_layers):
+            serialize(sd[f"layers.{i}.attention.wk.weight"])
+        for i in range(p.n_layers):
+            serialize(sd[f"layers.{i}.attention.wv.weight"])
         for layer in self.layers:
             serialize(layer.attention.wo.weight)
         # ffn weights
         for layer in self.layers:
             serialize(layer.ffn_norm.weight)
-        for layer in self.layers:
-            serialize(layer.feed_forward.w1.weight)
+        for i in range(p.n_layers):
+            serialize(sd[f"layers.{i}.feed_forward.w1.weight"])
         for layer in self.layers:
             serialize(layer.feed_forward.w2.weight)
-        for layer in self.layers:
-            serialize(layer.feed_forward.w3.weight)
+        for i in range(p.n_layers):
+            serialize(sd[f"layers.{i}.feed_forward.w3.weight"])
         # final rmsnorm
         serialize(self.norm.weight)
         # note: no need to write final classifier weights due to weight sharing
@@ -0,0 +1,189 @@
+"""
+Paged key/value cache: every layer keeps one pool of fixed-size blocks and each
+sequence owns a block table mapping its positions onto blocks, so memory is spent
+on tokens actually in use instead of max_seq_len per sequence. Blocks are reference
+counted; fork() lets sequences share a common prefix and a shared block is copied
+the first time one of its owners writes into it (copy-on-write). Example:
+
+>>> allocator = setup_paged_caches(model, max_bytes=2 * 2**30, block_size=16)
+>>> engine = Engine(model, max_batch_size=64, eos_id=enc.eos_id, allocator=allocator)
+"""
+
+from collections import deque
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple, Union
+
+import torch
+from torch import nn
+
+# This is a very hacky and temporary solution to make this work as a standalone script
+try:
+    from src.model import Transformer, causal_mask
+except ImportError:
+    from model import Transformer, causal_mask
+
+
+class BlockAllocator:
+    """
+    Host-side bookkeeping shared by the PagedKVCache of every layer. Block 0 is a
+    scratch block that absorbs writes from padding and backs unused table entries.
+    """
+
+    def __init__(self, num_blocks: int, block_size: int, bytes_per_block: int):
+        assert num_blocks > 1, "memory budget too small for a single block"
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.bytes_per_block = bytes_per_block
+        self.free_blocks = deque(range(1, num_blocks))
+        self.refcount = [0] * num_blocks
+        self.tables: Dict[Hashable, List[int]] = {}
+        self.caches: List["PagedKVCache"] = []
+
+        # per-step metadata consumed by PagedKVCache.update, built by prepare()
+        self.block_tables: Optional[torch.Tensor] = None  # (bs, n_blocks)
+        self.slot_mapping: Optional[torch.Tensor] = None  # (bs, seqlen) flat pool slot per token
+        self.kv_len = 0
+
+    @property
+    def num_free_blocks(self) -> int:
+        return len(self.free_blocks)
+
+    def blocks_for(self, n_tokens: int) -> int:
+        return (n_tokens + self.block_size - 1) // self.block_size
+
+    def bytes_for(self, n_tokens: int) -> int:
+        return self.blocks_for(n_tokens) * self.bytes_per_block
+
+    def can_allocate(self, n_tokens: int) -> bool:
+        return self.blocks_for(n_tokens) <= self.num_free_blocks
+
+    def _alloc(self) -> int:
+        block = self.free_blocks.popleft()
+        self.refcount[block] = 1
+        return block
+
+    def _decref(self, block: int):
+        self.refcount[block] -= 1
+        if self.refcount[block] == 0:
+            self.free_blocks.append(block)
+
+    def reserve(self, key: Hashable, start: int, end: int) -> bool:
+        """
+        Make positions [start, end) of sequence key writable: allocate missing blocks
+        and unshare any shared block in that range. Returns False, changing nothing,
+        when there are not enough free blocks.
+        """
+        table = self.tables.setdefault(key, [])
+        first, last = start // self.block_size, self.blocks_for(end)
+        shared = [j for j in range(first, min(last, len(table))) if self.refcount[table[j]] > 1]
+        if max(0, last - len(table)) + len(shared) > self.num_free_blocks:
+            return False
+        for j in shared:
+            block = self._alloc()
+            for cache in self.caches:
+                cache.copy_block(table[j], block)
+            self._decref(table[j])
+            table[j] = block
+        while len(table) < last:
+            table.append(self._alloc())
+        return True
+
+    def fork(self, src: Hashable, dst: Hashable, length: int):
+        """share the blocks holding the first length positions of src with a new sequence dst"""
+        assert dst not in self.tables or not self.tables[dst], "fork into a live sequence"
+        blocks = self.tables[src][: self.blocks_for(length)]
+        for block in blocks:
+            self.refcount[block] += 1
+        self.tables[dst] = list(blocks)
+
+    def free(self, key: Hashable):
+        for block in self.tables.pop(key, []):
+            self._decref(block)
+
+    def prepare(
+        self,
+        keys: Sequence[Optional[Hashable]],
+        start_pos: Sequence[int],
+        seqlens: Sequence[int],
+        seqlen: int,
+        max_seq_len: int,
+        device=None,
+    ):
+        """build the block tables and write slots for the next forward pass, row by row"""
+        self.kv_len = min(max(s + seqlen for s in start_pos), max_seq_len)
+        n_blocks = self.blocks_for(self.kv_len)
+        tables = torch.zeros((len(keys), n_blocks), dtype=torch.long)
+        slots = torch.zeros((len(keys), seqlen), dtype=torch.long)
+        for b, key in enumerate(keys):
+            if key is None:
+                continue  # unused row: reads and writes go to the scratch block
+            table = torch.tensor(self.tables[key][:n_blocks], dtype=torch.long)
+            tables[b, : len(table)] = table
+            pos = torch.arange(start_pos[b], start_pos[b] + seqlens[b])
+            slots[b, : seqlens[b]] = table[pos // self.block_size] * self.block_size + pos % self.block_size
+        self.block_tables = tables.to(device)
+        self.slot_mapping = slots.to(device)
+
+
+class PagedKVCache(nn.Module):
+    """drop-in replacement for KVCache that stores keys/values in the allocator's blocks"""
+
+    def __init__(
+        self,
+        allocator: BlockAllocator,
+        n_kv_heads: int,
+        head_dim: int,
+        dtype: torch.dtype = torch.float32,
+    ):
+        super().__init__()
+        self.allocator = allocator
+        shape = (allocator.num_blocks, allocator.block_size, n_kv_heads, head_dim)
+        self.register_buffer("k_pool", torch.zeros(shape, dtype=dtype), persistent=False)
+        self.register_buffer("v_pool", torch.zeros(shape, dtype=dtype), persistent=False)
+
+    def copy_block(self, src: int, dst: int):
+        self.k_pool[dst] = self.k_pool[src]
+        self.v_pool[dst] = self.v_pool[src]
+
+    def update(
+        self,
+        start_pos: Union[int, torch.Tensor],
+        xk: torch.Tensor,
+        xv: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
+        a = self.allocator
+        bsz, seqlen, n_kv_heads, head_dim = xk.shape
+        self.k_pool.view(-1, n_kv_heads, head_dim)[a.slot_mapping] = xk.to(self.k_pool.dtype)
+        self.v_pool.view(-1, n_kv_heads, head_dim)[a.slot_mapping] = xv.to(self.v_pool.dtype)
+        # gather every row's blocks back into a contiguous (bs, kv_len, ...) view
+        keys = self.k_pool[a.block_tables].view(bsz, -1, n_kv_heads, head_dim)[:, : a.kv_len]
+        values = self.v_pool[a.block_tables].view(bsz, -1, n_kv_heads, head_dim)[:, : a.kv_len]
+        if isinstance(start_pos, int):
+            start_pos = torch.full((bsz,), start_pos, dtype=torch.long, device=xk.device)
+        return keys, values, causal_mask(start_pos, seqlen, a.kv_len, xk.device)
+
+
+def block_bytes(model: Transformer, block_size: int = 16, dtype=None) -> int:
+    """bytes of keys and values one block holds across all layers"""
+    dtype = dtype or model.norm.weight.dtype
+    attn = model.layers[0].attention
+    return (
+        2 * model.n_layers * block_size * attn.n_local_kv_heads * attn.head_dim
+        * torch.tensor([], dtype=dtype).element_size()
+    )
+
+
+def setup_paged_caches(
+    model: Transformer, max_bytes: int, block_size: int = 16, dtype=None
+) -> BlockAllocator:
+    """give every attention layer a paged cache sharing one allocator, within max_bytes in total"""
+    dtype = dtype or model.norm.weight.dtype
+    device = model.norm.weight.device
+    bytes_per_block = block_bytes(model, block_size, dtype)
+    allocator = BlockAllocator(max_bytes // bytes_per_block, block_size, bytes_per_block)
+    for layer in model.layers:
+        cache = PagedKVCache(
+            allocator, layer.attention.n_local_kv_heads, layer.attention.head_dim, dtype
+        ).to(device)
+        layer.attention.cache = cache
+        allocator.caches.append(cache)
+    return allocator
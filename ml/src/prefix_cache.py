@@ -0,0 +1,90 @@
+"""
+Prefix key/value cache for shared prompt templates.
+
+Register the token ids of a template preamble (e.g. Prompter.prefix() or the mediqa
+"<<context>>\n" header, encoded with bos=True) and the engine stores the keys/values
+of that prefix the first time a request containing it is prefilled. Later requests
+starting with the same tokens get them copied straight into their cache slot, so
+prefill only covers the transcript-specific tail. Entries are evicted least recently
+used first once max_bytes is exceeded. Example:
+
+>>> prefixes = PrefixCache(max_bytes=512 * 2**20)
+>>> prefixes.register(enc.encode(Prompter().prefix(), bos=True, eos=False))
+>>> engine = Engine(model, eos_id=enc.eos_id, prefix_cache=prefixes)
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import torch
+
+KV = List[Tuple[torch.Tensor, torch.Tensor]]  # per-layer (keys, values)
+
+
+@dataclass
+class PrefixCacheStats:
+    hits: int = 0
+    misses: int = 0
+    hit_tokens: int = 0  # prefill tokens skipped thanks to the cache
+    evictions: int = 0
+
+
+class PrefixCache:
+    def __init__(self, max_bytes: int = 256 * 2**20):
+        self.max_bytes = max_bytes
+        self.registered = set()  # token tuples we want cached
+        self.entries: "OrderedDict[Tuple[int, ...], KV]" = OrderedDict()
+        self.sizes: Dict[Tuple[int, ...], int] = {}
+        self.bytes = 0
+        self.stats = PrefixCacheStats()
+        # called with the kv of every evicted entry, e.g. to free pinned paged blocks
+        self.on_evict: Optional[Callable[[Any], None]] = None
+
+    def register(self, tokens: List[int]):
+        """declare a template prefix worth caching"""
+        assert len(tokens) > 0, "empty prefix"
+        self.registered.add(tuple(tokens))
+
+    def _matches(self, tokens: List[int]) -> List[Tuple[int, ...]]:
+        # registered prefixes of tokens, longest first, always leaving one token to forward
+        lengths = sorted({len(p) for p in self.registered}, reverse=True)
+        return [
+            tuple(tokens[:n])
+            for n in lengths
+            if n < len(tokens) and tuple(tokens[:n]) in self.registered
+        ]
+
+    def lookup(self, tokens: List[int]) -> Tuple[int, Any]:
+        """longest cached prefix of tokens as (length, kv), or (0, None)"""
+        for key in self._matches(tokens):
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats.hits += 1
+                self.stats.hit_tokens += len(key)
+                return len(key), self.entries[key]
+        self.stats.misses += 1
+        return 0, None
+
+    def missing(self, tokens: List[int]) -> List[int]:
+        """lengths of registered prefixes of tokens that have no keys/values yet"""
+        return [len(key) for key in self._matches(tokens) if key not in self.entries]
+
+    def insert(self, tokens: List[int], kv: Any, size: Optional[int] = None):
+        """store kv for a prefix, size in bytes is measured from the tensors unless given"""
+        key = tuple(tokens)
+        if size is None:
+            size = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv)
+        if key in self.entries or size > self.max_bytes:
+            if self.on_evict is not None:
+                self.on_evict(kv)
+            return
+        self.entries[key] = kv
+        self.sizes[key] = size
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            old, old_kv = self.entries.popitem(last=False)
+            self.bytes -= self.sizes.pop(old)
+            self.stats.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(old_kv)
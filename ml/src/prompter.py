@@ -47,5 +47,10 @@ class Prompter(object):
             print(res)
         return res
 
+    def prefix(self, with_input: bool = True) -> str:
+        # the instruction preamble shared by every prompt built from this template
+        key = "prompt_input" if with_input else "prompt_no_input"
+        return self.template[key].split("{instruction}")[0]
+
     def get_response(self, output: str) -> str:
         return output.split(self.template["response_split"])[1].strip()
\ No newline at end of file
@@ -0,0 +1,195 @@
+"""
+Int8 quantization for CPU inference.
+
+Every nn.Linear in the attention/feed-forward blocks (wq, wk, wv, wo, w1, w2, w3) and
+the tied output/tok_embeddings matrix is stored as int8 with one fp32 scale per
+output channel (symmetric, absmax / 127), about a 4x cut in weight memory. On CPU
+the matmuls run int8 x int8 (torch._int_mm) with every token's activations
+quantized on the fly with their own scale, so a row's output does not depend on
+the rest of the batch. Elsewhere the weights are dequantized on every call
+instead, which only saves memory and is slower than fp32. Example, which also
+reports the perplexity delta on the validation shard:
+
+$ python src/quantize.py models/llama-large-pile-combinedsum --dataset=/mnt/d/datasets/mediqa/tokenized
+
+With --kv it also compares the int8 key/value cache (setup_caches(kv_int8=True))
+against the regular one: cache memory, and the error of every attention layer's
+output over a prefill followed by teacher-forced decode steps.
+"""
+
+import argparse
+import math
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+# This is a very hacky and temporary solution to make this work as a standalone script
+try:
+    from src.model import Transformer, model_bytes
+except ImportError:
+    from model import Transformer, model_bytes
+
+
+@torch.no_grad()
+def quantize_per_channel(w: torch.Tensor):
+    """symmetric int8 quantization of a (out, in) matrix, returns (int8 weight, fp32 scales (out,))"""
+    w = w.float()
+    scales = (w.abs().amax(dim=1) / 127.0).clamp(min=1e-8)
+    q = torch.round(w / scales[:, None]).clamp(-127, 127).to(torch.int8)
+    return q, scales
+
+
+class Int8Linear(nn.Module):
+    def __init__(self, weight: torch.Tensor, scales: torch.Tensor):
+        super().__init__()
+        self.out_features, self.in_features = weight.shape
+        self.register_buffer("weight", weight)
+        self.register_buffer("scales", scales)
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear) -> "Int8Linear":
+        assert linear.bias is None
+        return cls(*quantize_per_channel(linear.weight))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if x.device.type == "cpu" and hasattr(torch, "_int_mm"):
+            x2 = x.float().reshape(-1, self.in_features)
+            # per-token scales: padding and batch neighbours never change a row's result
+            x_scales = (x2.abs().amax(dim=-1, keepdim=True) / 127.0).clamp(min=1e-8)
+            xq = torch.round(x2 / x_scales).to(torch.int8)
+            y = torch._int_mm(xq, self.weight.t()).float() * x_scales * self.scales
+            return y.view(*x.shape[:-1], self.out_features).to(x.dtype)
+        # no int8 kernel: dequantize, this allocates a full copy of the weights every call
+        return F.linear(x, self.weight.to(x.dtype)) * self.scales.to(x.dtype)
+
+
+class Int8Embedding(nn.Module):
+    """embedding lookup into a row-quantized matrix, shares its buffers with the tied output layer"""
+
+    def __init__(self, weight: torch.Tensor, scales: torch.Tensor):
+        super().__init__()
+        self.register_buffer("weight", weight)
+        self.register_buffer("scales", scales)
+
+    def forward(self, tokens: torch.Tensor) -> torch.Tensor:
+        return self.weight[tokens].float() * self.scales[tokens, None]
+
+
+@torch.no_grad()
+def quantize_model(model: Transformer) -> Transformer:
+    """swap every projection of the model for its int8 version, in place"""
+    for layer in model.layers:
+        for name in ["wq", "wk", "wv", "wqkv", "wo"]:
+            if hasattr(layer.attention, name):  # fused or not
+                setattr(layer.attention, name, Int8Linear.from_linear(getattr(layer.attention, name)))
+        for name in ["w1", "w2", "w3", "w13"]:
+            if hasattr(layer.feed_forward, name):
+                setattr(
+                    layer.feed_forward, name, Int8Linear.from_linear(getattr(layer.feed_forward, name))
+                )
+    # the output projection and the embeddings are the same matrix, quantize it once
+    output = Int8Linear.from_linear(model.output)
+    model.output = output
+    model.tok_embeddings = Int8Embedding(output.weight, output.scales)
+    return model
+
+
+def load_int8(model_dir: str) -> Transformer:
+    """load a train.py checkpoint (ckpt.pt) and quantize it for CPU inference"""
+    return quantize_model(Transformer.from_pretrained(model_dir, "cpu"))
+
+
+@torch.no_grad()
+def _attention_outputs(model: Transformer, tokens: torch.Tensor, n_prompt: int, kv_int8: bool):
+    outputs = []
+    hooks = [
+        layer.attention.register_forward_hook(lambda m, i, o: outputs.append(o.float()))
+        for layer in model.layers
+    ]
+    model.setup_caches(tokens.size(0), kv_int8=kv_int8)
+    cache_bytes = sum(layer.attention.cache.nbytes for layer in model.layers)
+    model(tokens[:, :n_prompt], start_pos=0)
+    for pos in range(n_prompt, tokens.size(1)):
+        model(tokens[:, pos : pos + 1], start_pos=pos)
+    for hook in hooks:
+        hook.remove()
+    model.reset_caches()
+    return outputs, cache_bytes
+
+
+def kv_cache_report(model: Transformer, tokens: torch.Tensor, decode_steps: int = 32):
+    """
+    Run tokens (bs, t) through the model with a regular and an int8 kv cache, the last
+    decode_steps tokens one at a time. Returns (regular cache bytes, int8 cache bytes,
+    mean relative error, max absolute error) of the attention outputs.
+    """
+    n_prompt = max(1, tokens.size(1) - decode_steps)
+    ref, ref_bytes = _attention_outputs(model, tokens, n_prompt, kv_int8=False)
+    out, int8_bytes = _attention_outputs(model, tokens, n_prompt, kv_int8=True)
+    rel = [((o - r).norm() / r.norm().clamp(min=1e-8)).item() for o, r in zip(out, ref)]
+    max_abs = max((o - r).abs().max().item() for o, r in zip(out, ref))
+    return ref_bytes, int8_bytes, sum(rel) / len(rel), max_abs
+
+
+@torch.no_grad()
+def perplexity(model: Transformer, batches, eval_iters: int) -> float:
+    losses = []
+    for _ in range(eval_iters):
+        X, Y = next(batches)
+        model(X, Y)
+        losses.append(model.last_loss.item())
+    return math.exp(sum(losses) / len(losses))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_dir", type=str, help="train.py output directory with ckpt.pt.")
+    parser.add_argument("--dataset", type=str, default="", help="Tokenized dataset for perplexity.")
+    parser.add_argument("--eval_iters", type=int, default=20)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, 0 keeps the default")
+    parser.add_argument("--kv", action="store_true", help="Also report int8 kv cache error.")
+    args = parser.parse_args()
+
+    # only the perplexity runs need the dataset code and its dependencies
+    try:
+        from src.dataset import CustomTask
+    except ImportError:
+        from dataset import CustomTask
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    model = Transformer.from_pretrained(args.model_dir, "cpu")
+    fp32_bytes = model_bytes(model)
+    fp32_ppl = None
+    if args.dataset:
+        batches = CustomTask(args.dataset).iter_batches(
+            "val", args.batch_size, model.params.max_seq_len, "cpu"
+        )
+        fp32_ppl = perplexity(model, batches, args.eval_iters)
+
+    if args.kv:
+        if args.dataset:
+            tokens, _ = next(
+                CustomTask(args.dataset).iter_batches("val", 1, model.params.max_seq_len, "cpu")
+            )
+        else:
+            tokens = torch.randint(model.vocab_size, (1, model.params.max_seq_len))
+        ref_bytes, int8_bytes, rel_err, max_err = kv_cache_report(model, tokens)
+        print(
+            f"kv cache: {ref_bytes / 2**20:.1f}MiB -> {int8_bytes / 2**20:.1f}MiB int8 per sequence | attention output rel err {rel_err:.2e}, max abs err {max_err:.2e}"
+        )
+
+    quantize_model(model)
+    int8_bytes = model_bytes(model)
+    print(f"weights: {fp32_bytes / 2**20:.1f}MiB fp32 -> {int8_bytes / 2**20:.1f}MiB int8")
+    if args.dataset:
+        # same seed, so the same validation batches are seen again
+        batches = CustomTask(args.dataset).iter_batches(
+            "val", args.batch_size, model.params.max_seq_len, "cpu"
+        )
+        int8_ppl = perplexity(model, batches, args.eval_iters)
+        print(
+            f"perplexity: {fp32_ppl:.4f} fp32 -> {int8_ppl:.4f} int8 ({int8_ppl - fp32_ppl:+.4f})"
+        )
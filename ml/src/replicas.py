@@ -0,0 +1,138 @@
+"""
+Multi-process replica pool over one copy of the weights.
+
+The model is loaded once and moved to shared memory (share_memory()), worker
+processes receive it through torch.multiprocessing, which passes the storages
+by handle instead of copying them, so weight memory stays constant as workers
+are added. Every worker pins itself to its own slice of cores with its own torch
+thread count and runs a continuous-batching Engine; the pool hands requests to
+the workers round-robin. Example:
+
+$ python src/replicas.py models/llama-large-pile-combinedsum --workers=4 --threads_per_worker=8
+"""
+
+import argparse
+import itertools
+import os
+import queue
+import time
+from typing import Dict, List, Optional, Tuple
+
+import torch
+import torch.multiprocessing as mp
+
+# This is a very hacky and temporary solution to make this work as a standalone script
+try:
+    from src.engine import Engine, Request
+    from src.model import Transformer, model_bytes
+    from src.tokenizer import Tokenizer
+except ImportError:
+    from engine import Engine, Request
+    from model import Transformer, model_bytes
+    from tokenizer import Tokenizer
+
+
+def _worker(model: Transformer, jobs, results, threads: int, cores: List[int], engine_kwargs: dict):
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    engine = Engine(model, **engine_kwargs)
+    while True:
+        # block only when idle, otherwise pick up whatever arrived since the last step
+        try:
+            while True:
+                job = jobs.get(block=not engine.has_work())
+                if job is None:
+                    return
+                job_id, tokens, max_new_tokens = job
+                engine.submit(Request(tokens, max_new_tokens, request_id=job_id))
+        except queue.Empty:
+            pass
+        for req in engine.step():
+            results.put((req.request_id, req.output, req.finish_reason))
+
+
+class ReplicaPool:
+    def __init__(
+        self,
+        model: Transformer,
+        workers: int,
+        threads_per_worker: Optional[int] = None,
+        pin: bool = True,
+        **engine_kwargs,
+    ):
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+        threads_per_worker = threads_per_worker or max(1, (len(cores) or os.cpu_count()) // workers)
+        model.share_memory()
+        ctx = mp.get_context("spawn")
+        self.results = ctx.Queue()
+        self.jobs = [ctx.Queue() for _ in range(workers)]
+        self.procs = []
+        for rank in range(workers):
+            own = cores[rank * threads_per_worker : (rank + 1) * threads_per_worker] if pin else []
+            p = ctx.Process(
+                target=_worker,
+                args=(model, self.jobs[rank], self.results, threads_per_worker, own, engine_kwargs),
+                daemon=True,
+            )
+            p.start()
+            self.procs.append(p)
+        self._next_worker = itertools.cycle(range(workers))
+        self._next_id = 0
+
+    def submit(self, tokens: List[int], max_new_tokens: int = 256) -> int:
+        """send a prompt to the next worker, returns the job id its result will carry"""
+        job_id = self._next_id
+        self._next_id += 1
+        self.jobs[next(self._next_worker)].put((job_id, tokens, max_new_tokens))
+        return job_id
+
+    def result(self) -> Tuple[int, List[int], str]:
+        """(job id, output tokens, finish reason) of the next request to finish, on any worker"""
+        return self.results.get()
+
+    def generate(self, prompts: List[List[int]], max_new_tokens: int = 256) -> List[List[int]]:
+        """complete a list of prompts across all workers, keeping input order"""
+        ids = {self.submit(p, max_new_tokens): i for i, p in enumerate(prompts)}
+        outputs: Dict[int, List[int]] = {}
+        while len(outputs) < len(prompts):
+            job_id, output, _ = self.result()
+            outputs[ids[job_id]] = output
+        return [outputs[i] for i in range(len(prompts))]
+
+    def close(self):
+        for jobs in self.jobs:
+            jobs.put(None)
+        for p in self.procs:
+            p.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_dir", type=str)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads_per_worker", type=int, default=None)
+    parser.add_argument("--max_batch_size", type=int, default=8, help="Engine slots per worker.")
+    parser.add_argument("--n_requests", type=int, default=32)
+    parser.add_argument("--max_new_tokens", type=int, default=128)
+    parser.add_argument("--prompt", type=str, default="<<context>>\n")
+    args = parser.parse_args()
+
+    enc = Tokenizer()
+    model = Transformer.from_pretrained(args.model_dir, "cpu")
+    pool = ReplicaPool(
+        model,
+        args.workers,
+        args.threads_per_worker,
+        max_batch_size=args.max_batch_size,
+        eos_id=enc.eos_id,
+    )
+    prompt = enc.encode(args.prompt, bos=True, eos=False)
+    t0 = time.time()
+    outputs = pool.generate([prompt] * args.n_requests, args.max_new_tokens)
+    dt = time.time() - t0
+    pool.close()
+    n_tokens = sum(len(o) for o in outputs)
+    print(
+        f"{args.workers} workers | weights {model_bytes(model) / 2**20:.1f}MiB shared | {n_tokens / dt:.2f} tokens/s"
+    )
@@ -0,0 +1,437 @@
+"""
+Local asyncio HTTP server for summarization, stdlib only.
+
+Requests wait in a bounded queue (503 once max_queue are waiting) and are fed to
+one continuous-batching Engine. When the engine is idle the scheduler waits
+batch_window seconds after the first arrival so concurrent requests start in the
+same micro-batch; while it is busy new requests join at the next step. Steps run
+in a worker thread so the event loop keeps accepting connections and streaming.
+
+$ python src/server.py models/llama-large-pile-combinedsum --port=8000 --max_batch_size=8
+$ curl -N localhost:8000/generate -d '{"transcript": "Doctor: ...", "stream": true}'
+$ curl localhost:8000/metrics
+
+POST /generate takes {"prompt": str} or {"transcript": str} (wrapped in the mediqa
+"<<context>>" / "<<summary>>" format) plus optional "max_new_tokens", "stop" and
+"stream". Streamed responses are newline-delimited json: {"text": delta} lines and
+a final {"done": true, ...} line. With --cache_dir, repeated prompts are answered
+from a SummaryCache and identical concurrent ones share a single generation; such
+results carry "cached": true and the latency of the request they answer.
+Malformed bodies get a 400. If an engine step fails, the requests in it get a 500
+(or a final {"error": ...} line once streaming) and the server keeps going.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Deque, List, Optional, Tuple
+
+import torch
+
+# This is a very hacky and temporary solution to make this work as a standalone script
+try:
+    from src.engine import Engine, Request
+    from src.kernels import configure_kernels
+    from src.model import Transformer
+    from src.streaming import TextStream
+    from src.summary_cache import SummaryCache, model_fingerprint
+    from src.tokenizer import Tokenizer
+except ImportError:
+    from engine import Engine, Request
+    from kernels import configure_kernels
+    from model import Transformer
+    from streaming import TextStream
+    from summary_cache import SummaryCache, model_fingerprint
+    from tokenizer import Tokenizer
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+@dataclass(eq=False)
+class Job:
+    request: Request
+    text: TextStream
+    deltas: asyncio.Queue  # text deltas for the client, None once finished
+    submitted: float
+    done: asyncio.Future  # {"text", "finish_reason", "tokens"} once finished
+    first_token: Optional[float] = None
+    seen: int = 0  # tokens of request.output already pushed through text
+    pieces: List[str] = field(default_factory=list)  # text pushed to deltas so far
+    cancelled: bool = False  # the client went away
+
+
+@dataclass
+class ServerMetrics:
+    started: float = field(default_factory=time.time)
+    completed: int = 0
+    rejected: int = 0
+    generated_tokens: int = 0
+    latencies: Deque[float] = field(default_factory=lambda: deque(maxlen=1024))
+    first_token_latencies: Deque[float] = field(default_factory=lambda: deque(maxlen=1024))
+
+    def snapshot(self, engine: Engine, queued: int) -> dict:
+        uptime = time.time() - self.started
+        return {
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "queued": queued,
+            "active": sum(r is not None for r in engine.slots),
+            "latency_p50": percentile(list(self.latencies), 50),
+            "latency_p99": percentile(list(self.latencies), 99),
+            "first_token_p50": percentile(list(self.first_token_latencies), 50),
+            "first_token_p99": percentile(list(self.first_token_latencies), 99),
+            "tokens_per_sec": self.generated_tokens / uptime if uptime > 0 else 0.0,
+            "busy_tokens_per_sec": engine.stats.tokens_per_sec,
+            "mean_occupancy": engine.stats.mean_occupancy,
+        }
+
+
+class QueueFull(Exception):
+    pass
+
+
+class GenerationFailed(Exception):
+    pass
+
+
+class Server:
+    def __init__(
+        self,
+        engine: Engine,
+        tokenizer: Tokenizer,
+        batch_window: float = 0.01,
+        max_queue: int = 64,
+        cache: Optional[SummaryCache] = None,
+    ):
+        self.engine = engine
+        self.tokenizer = tokenizer
+        self.batch_window = batch_window
+        self.max_queue = max_queue
+        self.cache = cache  # answers repeated prompts without generating
+        self.incoming: List[Job] = []  # handed to the engine between steps only
+        self.live: List[Job] = []
+        self.metrics = ServerMetrics()
+        self.wakeup = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def queued(self) -> int:
+        return len(self.incoming) + len(self.engine.queue)
+
+    def submit(
+        self, tokens: List[int], max_new_tokens: int, stop: List[str], deltas: Optional[asyncio.Queue] = None
+    ) -> Optional[Job]:
+        """queue a request, None when the queue is full"""
+        if self.queued >= self.max_queue:
+            self.metrics.rejected += 1
+            return None
+        job = Job(
+            Request(tokens, max_new_tokens),
+            TextStream(self.tokenizer, stop),
+            asyncio.Queue() if deltas is None else deltas,
+            time.time(),
+            asyncio.get_running_loop().create_future(),
+        )
+        self.incoming.append(job)
+        self.wakeup.set()
+        return job
+
+    async def schedule(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.engine.has_work() and not self.incoming:
+                await self.wakeup.wait()
+                # give concurrent arrivals the latency window to join the first batch
+                await asyncio.sleep(self.batch_window)
+            self.wakeup.clear()
+            for job in self.incoming:
+                try:
+                    self.engine.submit(job.request)
+                except Exception as e:
+                    self._fail([job], e)
+                    continue
+                self.live.append(job)
+            self.incoming = []
+            try:
+                await loop.run_in_executor(self.executor, self.engine.step)
+            except Exception as e:
+                # the step may have advanced any running sequence, none of them can be
+                # trusted: fail them all and keep serving new requests
+                self._fail(list(self.live), e)
+                continue
+            self._dispatch()
+
+    def _fail(self, jobs: List[Job], error: Exception):
+        print(f"generation failed for {len(jobs)} requests")
+        traceback.print_exception(type(error), error, error.__traceback__)
+        for job in jobs:
+            self.engine.cancel(job.request, "error")
+            if job in self.live:
+                self.live.remove(job)
+            job.deltas.put_nowait(None)
+            if not job.done.done():
+                job.done.set_exception(GenerationFailed(f"{type(error).__name__}: {error}"))
+                job.done.exception()  # delivered through run(), never "never retrieved"
+
+    def _dispatch(self):
+        now = time.time()
+        for job in list(self.live):
+            req = job.request
+            if job.cancelled:
+                self.engine.cancel(req)
+            for token in req.output[job.seen :]:
+                if job.first_token is None:
+                    job.first_token = now
+                if token == self.tokenizer.eos_id:
+                    self.engine.cancel(req, "eos")
+                    break
+                delta = job.text.push(token)
+                if delta:
+                    job.pieces.append(delta)
+                    job.deltas.put_nowait(delta)
+                if job.text.stopped:
+                    self.engine.cancel(req, "stop")
+                    break
+            self.metrics.generated_tokens += len(req.output) - job.seen
+            job.seen = len(req.output)
+            if req.finish_reason is not None:
+                delta = job.text.flush()
+                if delta:
+                    job.pieces.append(delta)
+                    job.deltas.put_nowait(delta)
+                job.deltas.put_nowait(None)
+                if not job.done.done():  # cancelled when its client went away
+                    job.done.set_result(
+                        {
+                            "text": "".join(job.pieces),
+                            "finish_reason": req.finish_reason,
+                            "tokens": len(req.output),
+                        }
+                    )
+                self.live.remove(job)
+                self.metrics.completed += 1
+                self.metrics.latencies.append(now - job.submitted)
+                if job.first_token is not None:
+                    self.metrics.first_token_latencies.append(job.first_token - job.submitted)
+
+    def _parse(self, body) -> Tuple[str, int, List[str], bool]:
+        """(prompt, max_new_tokens, stop, stream) of a /generate body, ValueError if malformed"""
+        if not isinstance(body, dict):
+            raise ValueError("expected a json object")
+        if "transcript" in body:
+            if not isinstance(body["transcript"], str):
+                raise ValueError("transcript must be a string")
+            prompt = f"<<context>>\n{body['transcript']}\n\n<<summary>>\n"
+        elif isinstance(body.get("prompt"), str) and body["prompt"]:
+            prompt = body["prompt"]
+        else:
+            raise ValueError("expected a non-empty string prompt or a transcript")
+        max_new_tokens = body.get("max_new_tokens", 256)
+        if type(max_new_tokens) is not int or max_new_tokens < 1:
+            raise ValueError("max_new_tokens must be a positive integer")
+        stop = body.get("stop", [])
+        if not isinstance(stop, list) or not all(isinstance(s, str) and s for s in stop):
+            raise ValueError("stop must be a list of non-empty strings")
+        stream = body.get("stream", False)
+        if not isinstance(stream, bool):
+            raise ValueError("stream must be true or false")
+        return prompt, max_new_tokens, stop, stream
+
+    async def _stream(self, writer: asyncio.StreamWriter, deltas: asyncio.Queue, compute: asyncio.Future) -> bool:
+        """write the deltas of this request's own generation as they come, False if there were none"""
+        started = False
+        while True:
+            get = asyncio.ensure_future(deltas.get())
+            await asyncio.wait([get, compute], return_when=asyncio.FIRST_COMPLETED)
+            if not get.done():
+                # finished, failed, or answered by the cache or another request
+                get.cancel()
+                if deltas.empty():
+                    return started
+                delta = deltas.get_nowait()
+            else:
+                delta = get.result()
+            if delta is None:
+                return started
+            if not started:
+                start_stream(writer)
+                started = True
+            await write_chunk(writer, {"text": delta})
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            method, path, _ = (await reader.readline()).decode().split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, value = line.decode().split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if method == "GET" and path == "/metrics":
+                metrics = self.metrics.snapshot(self.engine, self.queued)
+                if self.cache is not None:
+                    metrics["cache"] = asdict(self.cache.stats)
+                await respond(writer, 200, metrics)
+            elif method == "GET" and path == "/health":
+                await respond(writer, 200, {"ok": True})
+            elif method == "POST" and path == "/generate":
+                await self.generate(writer, json.loads(body or b"{}"))
+            else:
+                await respond(writer, 404, {"error": f"no route {method} {path}"})
+        except (ValueError, KeyError) as e:
+            await respond(writer, 400, {"error": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def generate(self, writer: asyncio.StreamWriter, body: dict):
+        prompt, max_new_tokens, stop, stream = self._parse(body)
+        t0 = time.time()
+        deltas: asyncio.Queue = asyncio.Queue()  # only filled if this request runs the generation
+        job: Optional[Job] = None
+
+        async def run() -> dict:
+            # the generation alone, so errors writing to this client never reach coalesced requests
+            nonlocal job
+            job = self.submit(
+                self.tokenizer.encode(prompt, bos=True, eos=False), max_new_tokens, stop, deltas
+            )
+            if job is None:
+                raise QueueFull()
+            return await job.done
+
+        if self.cache is None:
+            compute = asyncio.ensure_future(run())
+        else:
+            key = self.cache.key(
+                prompt,
+                max_new_tokens=max_new_tokens,
+                stop=stop,
+                temperature=self.engine.temperature,
+                top_k=self.engine.top_k,
+            )
+            compute = asyncio.ensure_future(self.cache.aget_or_compute(key, run))
+
+        started = False
+        try:
+            if stream:
+                started = await self._stream(writer, deltas, compute)
+            result = await compute
+        except QueueFull:
+            await respond(writer, 503, {"error": "queue full"}, {"Retry-After": "1"})
+            return
+        except GenerationFailed as e:
+            if not started:
+                await respond(writer, 500, {"error": str(e)})
+                return
+            # the 200 status is already out, end the stream on an error line
+            await write_chunk(writer, {"error": str(e), "done": True})
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+            return
+        except ConnectionError:
+            # stop generating for a client that is gone; requests coalesced onto
+            # this one see the cancellation and start their own generation
+            if job is not None:
+                job.cancelled = True
+            compute.cancel()
+            raise
+        # cached: answered from the cache or by an identical in-flight request
+        result = dict(result, done=True, latency=time.time() - t0, cached=job is None)
+        if not stream:
+            await respond(writer, 200, result)
+            return
+        if not started:
+            start_stream(writer)
+            await write_chunk(writer, {"text": result["text"]})
+        await write_chunk(writer, {k: v for k, v in result.items() if k != "text"})
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+def start_stream(writer: asyncio.StreamWriter):
+    writer.write(
+        b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+        b"Transfer-Encoding: chunked\r\n\r\n"
+    )
+
+
+async def write_chunk(writer: asyncio.StreamWriter, obj: dict):
+    data = (json.dumps(obj) + "\n").encode()
+    writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+    await writer.drain()  # backpressure from slow clients
+
+
+async def respond(writer: asyncio.StreamWriter, status: int, obj: dict, headers: Optional[dict] = None):
+    reasons = {
+        200: "OK",
+        400: "Bad Request",
+        404: "Not Found",
+        500: "Internal Server Error",
+        503: "Service Unavailable",
+    }
+    data = json.dumps(obj).encode()
+    head = f"HTTP/1.1 {status} {reasons[status]}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+    for key, value in (headers or {}).items():
+        head += f"{key}: {value}\r\n"
+    writer.write(head.encode() + b"\r\n" + data)
+    await writer.drain()
+
+
+async def serve(server: Server, host: str, port: int):
+    scheduler = asyncio.create_task(server.schedule())
+    listener = await asyncio.start_server(server.handle, host, port)
+    print(f"listening on http://{host}:{port}")
+    async with listener:
+        await asyncio.gather(listener.serve_forever(), scheduler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_dir", type=str)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch_size", type=int, default=8)
+    parser.add_argument("--batch_window_ms", type=float, default=10.0)
+    parser.add_argument("--max_queue", type=int, default=64, help="Waiting requests before 503.")
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--cache_dir", type=str, default="", help="Summary cache, off if empty.")
+    parser.add_argument("--cache_mb", type=int, default=1024, help="On-disk summary cache budget.")
+    parser.add_argument("--kernels", type=str, default="", help='e.g. "attention=chunked", or "auto" to benchmark.')
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, 0 keeps the default")
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    enc = Tokenizer()
+    engine = Engine(
+        Transformer.from_pretrained(args.model_dir, args.device),
+        max_batch_size=args.max_batch_size,
+        eos_id=enc.eos_id,
+        temperature=args.temperature,
+    )
+    if args.kernels:
+        params = engine.model.params
+        print(f"kernels: {configure_kernels(args.kernels, params, 1, params.max_seq_len, device=args.device)}")
+    cache = None
+    if args.cache_dir:
+        cache = SummaryCache(
+            model_fingerprint(engine.model), args.cache_dir, max_disk_bytes=args.cache_mb * 2**20
+        )
+    server = Server(engine, enc, args.batch_window_ms / 1000, args.max_queue, cache)
+    asyncio.run(serve(server, args.host, args.port))
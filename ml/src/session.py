@@ -0,0 +1,119 @@
+"""
+Incremental summarization of a transcript that grows during a visit.
+
+The session keeps one kv cache laid out as [header, transcript, footer, summary].
+New transcript text is prefilled on top of the transcript already cached,
+overwriting the previous footer and summary, so an update costs the new tokens
+plus the regenerated summary instead of the whole visit. Example, in the mediqa
+format:
+
+>>> session = SummarySession(model, enc)
+>>> session.append("Doctor: What brings you in today?")
+>>> session.append("Patient: I've had a cough for two weeks.")
+>>> print(session.summarize())
+"""
+
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+import torch
+
+# This is a very hacky and temporary solution to make this work as a standalone script
+try:
+    from src.model import Transformer, sample
+    from src.tokenizer import Tokenizer
+except ImportError:
+    from model import Transformer, sample
+    from tokenizer import Tokenizer
+
+
+@dataclass
+class SessionStats:
+    updates: int = 0
+    prefill_tokens: int = 0  # transcript and footer tokens forwarded
+    generated_tokens: int = 0
+    recomputed: int = 0  # times the transcript outgrew the context and was re-prefilled
+    last_latency: float = 0.0
+
+
+class SummarySession:
+    def __init__(
+        self,
+        model: Transformer,
+        tokenizer: Tokenizer,
+        max_new_tokens: int = 256,
+        temperature: float = 0.0,
+        top_k: Optional[int] = None,
+        header: str = "<<context>>\n",
+        footer: str = "\n\n<<summary>>\n",
+        sep: str = "\n",
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.device = model.norm.weight.device
+        self.header = tokenizer.encode(header, bos=True, eos=False)
+        self.footer = tokenizer.encode_continuation(footer)
+        self.sep = sep  # joins successive append() calls, e.g. one utterance per line
+        self.tokens: List[int] = list(self.header)  # header + transcript so far
+        self.pos = 0  # leading tokens of self.tokens already in the kv cache
+        self.summary: List[int] = []
+        self.stats = SessionStats()
+        budget = model.params.max_seq_len - len(self.footer) - max_new_tokens
+        assert budget > len(self.header), "max_new_tokens leaves no room for the transcript"
+        model.setup_caches(1)
+
+    def append(self, text: str):
+        """add transcript text, it is only forwarded on the next summarize()"""
+        if len(self.tokens) > len(self.header):
+            text = self.sep + text
+        # encoded as a continuation so pieces join like they would inside one string;
+        # token boundaries at the seams may still differ from encoding the full text
+        self.tokens.extend(self.tokenizer.encode_continuation(text))
+
+    def _crop(self):
+        # past the context window keep the header and the latest transcript, which
+        # shifts every position, so the whole cache has to be rebuilt. A quarter of
+        # the transcript budget is left free so the next updates append incrementally
+        budget = self.model.params.max_seq_len - len(self.footer) - self.max_new_tokens
+        if len(self.tokens) > budget:
+            n = len(self.header)
+            keep = budget - n - max(1, (budget - n) // 4)
+            self.tokens = self.header + self.tokens[len(self.tokens) - keep :]
+            self.pos = 0
+            self.stats.recomputed += 1
+
+    @torch.inference_mode()
+    def summarize(self) -> str:
+        """(re)generate the summary of everything appended so far"""
+        t0 = time.time()
+        self._crop()
+        pending = self.tokens[self.pos :] + self.footer
+        pos = self.pos
+        # the footer and old summary sit after the transcript, the next update overwrites them
+        self.pos = len(self.tokens)
+        self.summary = []
+        self.stats.prefill_tokens += len(pending)
+        for _ in range(self.max_new_tokens):
+            logits = self.model(torch.tensor([pending], device=self.device), start_pos=pos)
+            token = sample(logits[:, -1, :], self.temperature, self.top_k).item()
+            pos += len(pending)
+            if token == self.tokenizer.eos_id:
+                break
+            self.summary.append(token)
+            pending = [token]
+        self.stats.updates += 1
+        self.stats.generated_tokens += len(self.summary)
+        self.stats.last_latency = time.time() - t0
+        return self.tokenizer.decode(self.summary)
+
+    def update(self, text: str) -> str:
+        """append new transcript text and return the refreshed summary"""
+        self.append(text)
+        return self.summarize()
+
+    def close(self):
+        self.model.reset_caches()
@@ -0,0 +1,300 @@
+"""
+Speculative decoding between two Transformer checkpoints that share tokenizer.model.
+The small draft model proposes k tokens autoregressively, the large target model
+scores all of them in one forward pass, and the accept/resample rule keeps the output
+distributed exactly as if the target had sampled on its own. Example:
+
+$ python src/speculative.py --target=models/llama-large-pile --draft=models/tinyllama --k=4
+
+Without a draft model, prompt lookup drafts by copying: the last n tokens are matched
+against the transcript (and the output so far) and the tokens that followed the
+match are proposed. Summaries copy medication names and phrases verbatim, so these
+drafts are often accepted whole:
+
+$ python src/speculative.py --target=models/llama-large-pile --ngram=3 --k=8
+"""
+
+import argparse
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+import torch
+import torch.nn.functional as F
+
+# This is a very hacky and temporary solution to make this work as a standalone script
+try:
+    from src.model import Transformer
+    from src.tokenizer import Tokenizer
+except ImportError:
+    from model import Transformer
+    from tokenizer import Tokenizer
+
+
+def logits_to_probs(logits: torch.Tensor, temperature: float = 1.0, top_k: Optional[int] = None):
+    """(..., vocab_size) logits to sampling probabilities, one-hot on the argmax when temperature is 0"""
+    if temperature == 0.0:
+        return F.one_hot(logits.argmax(dim=-1), logits.size(-1)).float()
+    logits = logits / temperature
+    if top_k is not None:
+        v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+        logits = logits.masked_fill(logits < v[..., [-1]], -float("Inf"))
+    return F.softmax(logits.float(), dim=-1)
+
+
+def verify(
+    draft_tokens: List[int],
+    draft_probs: Optional[torch.Tensor],
+    target_probs: torch.Tensor,
+) -> List[int]:
+    """
+    Speculative sampling acceptance rule (Leviathan et al. 2023). target_probs holds
+    len(draft_tokens) + 1 rows; returns the accepted prefix of draft_tokens followed by
+    one token drawn from the target (a correction or the bonus token).
+    draft_probs=None means the drafts were proposed deterministically (q = 1).
+    """
+    target_probs = target_probs.cpu()
+    draft_probs = draft_probs.cpu() if draft_probs is not None else None
+    out = []
+    for i, token in enumerate(draft_tokens):
+        p = target_probs[i, token].item()
+        q = 1.0 if draft_probs is None else draft_probs[i, token].item()
+        if torch.rand(1).item() < p / q:
+            out.append(token)
+            continue
+        # rejected: resample from the leftover mass max(0, p - q)
+        if draft_probs is None:
+            residual = target_probs[i].clone()
+            residual[token] = 0.0
+        else:
+            residual = (target_probs[i] - draft_probs[i]).clamp(min=0.0)
+        if residual.sum() <= 0:
+            residual = target_probs[i]
+        out.append(torch.multinomial(residual / residual.sum(), 1).item())
+        return out
+    out.append(torch.multinomial(target_probs[len(draft_tokens)], 1).item())
+    return out
+
+
+@dataclass
+class SpeculativeStats:
+    rounds: int = 0
+    drafted_rounds: int = 0  # rounds that had anything to propose
+    proposed: int = 0
+    accepted: int = 0
+    generated: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.proposed if self.proposed > 0 else 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.drafted_rounds / self.rounds if self.rounds > 0 else 0.0
+
+    @property
+    def tokens_per_round(self) -> float:
+        return self.generated / self.rounds if self.rounds > 0 else 0.0
+
+    @property
+    def tokens_per_sec(self) -> float:
+        return self.generated / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class SpeculativeDecoder:
+    def __init__(
+        self,
+        target: Transformer,
+        draft: Transformer,
+        k: int = 4,
+        temperature: float = 0.0,
+        top_k: Optional[int] = None,
+    ):
+        assert target.vocab_size == draft.vocab_size, "models must share a tokenizer"
+        self.target = target
+        self.draft = draft
+        self.k = k
+        self.temperature = temperature
+        self.top_k = top_k
+        self.stats = SpeculativeStats()
+
+    @torch.inference_mode()
+    def generate(self, idx: torch.Tensor, max_new_tokens: int, eos_id: Optional[int] = None):
+        """same contract as Transformer.generate for a single sequence idx of shape (1, t)"""
+        assert idx.size(0) == 1, "speculative decoding runs one sequence at a time"
+        device = idx.device
+        max_seq_len = min(self.target.params.max_seq_len, self.draft.params.max_seq_len)
+        keep = max(1, max_seq_len - max_new_tokens)
+        tokens = idx[0, -keep:].tolist()
+        n_prompt = len(tokens)
+        cache_len = min(max_seq_len, n_prompt + max_new_tokens + self.k + 1)
+        self.target.setup_caches(1, cache_len)
+        self.draft.setup_caches(1, cache_len)
+
+        # number of leading tokens already in each model's kv cache
+        target_pos = draft_pos = 0
+        t0 = time.time()
+        while True:
+            remaining = max_new_tokens - (len(tokens) - n_prompt)
+            if remaining <= 0 or len(tokens) >= cache_len:
+                break
+            k = max(0, min(self.k, remaining - 1, cache_len - len(tokens)))
+
+            # draft k tokens with the small model
+            drafts, draft_probs = [], []
+            pending = tokens[draft_pos:]
+            for _ in range(k):
+                logits = self.draft(torch.tensor([pending], device=device), start_pos=draft_pos)
+                draft_pos += len(pending)
+                probs = logits_to_probs(logits[0, -1], self.temperature, self.top_k)
+                token = torch.multinomial(probs, 1).item()
+                drafts.append(token)
+                draft_probs.append(probs)
+                pending = [token]
+
+            # score every draft with the large model in a single forward pass
+            pending = tokens[target_pos:] + drafts
+            logits = self.target(
+                torch.tensor([pending], device=device), start_pos=target_pos, all_logits=True
+            )
+            target_probs = logits_to_probs(logits[0, -(k + 1) :], self.temperature, self.top_k)
+            accepted = verify(
+                drafts, torch.stack(draft_probs) if drafts else None, target_probs
+            )
+
+            self.stats.rounds += 1
+            self.stats.drafted_rounds += int(k > 0)
+            self.stats.proposed += k
+            self.stats.accepted += len(accepted) - 1
+            tokens.extend(accepted)
+            # the last token is new to both caches, rejected drafts are simply overwritten
+            target_pos = len(tokens) - 1
+            draft_pos = min(draft_pos, len(tokens) - 1)
+            if eos_id is not None and eos_id in accepted:
+                tokens = tokens[: len(tokens) - len(accepted) + accepted.index(eos_id) + 1]
+                break
+
+        new_tokens = tokens[n_prompt:][:max_new_tokens]
+        self.stats.generated += len(new_tokens)
+        self.stats.elapsed += time.time() - t0
+        self.target.reset_caches()
+        self.draft.reset_caches()
+        new_tokens = torch.tensor([new_tokens], dtype=idx.dtype, device=device)
+        return torch.cat((idx, new_tokens), dim=1)
+
+
+def lookup_draft(tokens: List[int], ngram: int, k: int) -> List[int]:
+    """
+    Find the most recent earlier occurrence of the last n tokens (n = ngram down to 1)
+    and return up to k tokens that followed it, or [] when nothing matches.
+    """
+    for n in range(min(ngram, len(tokens) - 1), 0, -1):
+        pattern = tokens[-n:]
+        for j in range(len(tokens) - n - 1, -1, -1):
+            if tokens[j : j + n] == pattern:
+                return tokens[j + n : j + n + k]
+    return []
+
+
+class PromptLookupDecoder:
+    """speculative decoding without a draft model, drafts are copied from the context"""
+
+    def __init__(
+        self,
+        model: Transformer,
+        k: int = 8,
+        ngram: int = 3,
+        temperature: float = 0.0,
+        top_k: Optional[int] = None,
+    ):
+        self.model = model
+        self.k = k
+        self.ngram = ngram
+        self.temperature = temperature
+        self.top_k = top_k
+        self.stats = SpeculativeStats()
+
+    @torch.inference_mode()
+    def generate(self, idx: torch.Tensor, max_new_tokens: int, eos_id: Optional[int] = None):
+        """same contract as Transformer.generate for a single sequence idx of shape (1, t)"""
+        assert idx.size(0) == 1, "prompt lookup runs one sequence at a time"
+        device = idx.device
+        max_seq_len = self.model.params.max_seq_len
+        keep = max(1, max_seq_len - max_new_tokens)
+        tokens = idx[0, -keep:].tolist()
+        n_prompt = len(tokens)
+        cache_len = min(max_seq_len, n_prompt + max_new_tokens + self.k + 1)
+        self.model.setup_caches(1, cache_len)
+
+        pos = 0  # number of leading tokens already in the kv cache
+        t0 = time.time()
+        while True:
+            remaining = max_new_tokens - (len(tokens) - n_prompt)
+            if remaining <= 0 or len(tokens) >= cache_len:
+                break
+            k = max(0, min(self.k, remaining - 1, cache_len - len(tokens)))
+            drafts = lookup_draft(tokens, self.ngram, k) if k > 0 else []
+
+            # verify the copied span in one forward pass; q = 1 for every draft
+            pending = tokens[pos:] + drafts
+            logits = self.model(torch.tensor([pending], device=device), start_pos=pos, all_logits=True)
+            target_probs = logits_to_probs(
+                logits[0, -(len(drafts) + 1) :], self.temperature, self.top_k
+            )
+            accepted = verify(drafts, None, target_probs)
+
+            self.stats.rounds += 1
+            self.stats.drafted_rounds += int(len(drafts) > 0)
+            self.stats.proposed += len(drafts)
+            self.stats.accepted += len(accepted) - 1
+            tokens.extend(accepted)
+            pos = len(tokens) - 1
+            if eos_id is not None and eos_id in accepted:
+                tokens = tokens[: len(tokens) - len(accepted) + accepted.index(eos_id) + 1]
+                break
+
+        new_tokens = tokens[n_prompt:][:max_new_tokens]
+        self.stats.generated += len(new_tokens)
+        self.stats.elapsed += time.time() - t0
+        self.model.reset_caches()
+        new_tokens = torch.tensor([new_tokens], dtype=idx.dtype, device=device)
+        return torch.cat((idx, new_tokens), dim=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", type=str, required=True, help="Large model directory.")
+    parser.add_argument(
+        "--draft", type=str, default="", help="Small model directory, prompt lookup if empty."
+    )
+    parser.add_argument("--ngram", type=int, default=3, help="Prompt lookup match length.")
+    parser.add_argument("--prompt", type=str, default="<<context>>\n")
+    parser.add_argument("--k", type=int, default=4, help="Tokens drafted per round.")
+    parser.add_argument("--max_new_tokens", type=int, default=256)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--top_k", type=int, default=None)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    enc = Tokenizer()
+    target = Transformer.from_pretrained(args.target, args.device)
+    if args.draft:
+        decoder = SpeculativeDecoder(
+            target,
+            Transformer.from_pretrained(args.draft, args.device),
+            k=args.k,
+            temperature=args.temperature,
+            top_k=args.top_k,
+        )
+    else:
+        decoder = PromptLookupDecoder(
+            target, k=args.k, ngram=args.ngram, temperature=args.temperature, top_k=args.top_k
+        )
+    idx = torch.tensor([enc.encode(args.prompt, bos=True, eos=False)], device=args.device)
+    out = decoder.generate(idx, args.max_new_tokens, eos_id=enc.eos_id)
+    print(enc.decode(out[0, idx.size(1) :].tolist()))
+    s = decoder.stats
+    print(
+        f"hit rate {s.hit_rate:.2%} | acceptance rate {s.acceptance_rate:.2%} | {s.tokens_per_round:.2f} tokens/round | {s.tokens_per_sec:.2f} tokens/s"
+    )
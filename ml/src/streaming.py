@@ -0,0 +1,111 @@
+"""
+Streaming generation: yields text deltas as soon as tokens are sampled.
+
+Token ids are detokenized incrementally from a per-id byte table (SentencePiece
+byte pieces are buffered until they form complete utf-8 characters, and the
+leading "▁" becomes a space), so nothing is re-decoded per step. Every sequence
+stops on its own at eos, at one of the stop strings or at max_new_tokens, and its
+slot in the engine is freed immediately. Example:
+
+>>> for i, delta in stream(engine, enc, [transcript], stop=["<<topic>>"]):
+...     print(delta, end="", flush=True)
+"""
+
+import codecs
+from typing import Iterator, List, Sequence, Tuple
+
+# This is a very hacky and temporary solution to make this work as a standalone script
+try:
+    from src.engine import Engine, Request
+    from src.tokenizer import Tokenizer
+except ImportError:
+    from engine import Engine, Request
+    from tokenizer import Tokenizer
+
+
+class TextStream:
+    """incremental detokenizer for one sequence, holding back text that may start a stop string"""
+
+    def __init__(self, tokenizer: Tokenizer, stop: Sequence[str] = ()):
+        self.piece_bytes = tokenizer.piece_bytes()
+        self.stop = [s for s in stop if s]
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.buffer = ""  # decoded text not yet handed out
+        self.started = False
+        self.stopped = False
+
+    def push(self, token: int) -> str:
+        """feed one token id, returns the text that is now safe to emit"""
+        if self.stopped:
+            return ""
+        b = self.piece_bytes[token]
+        if not self.started and b:
+            # like sp_model.decode, drop the dummy-prefix space of the first piece
+            b = b[1:] if b.startswith(b" ") else b
+            self.started = True
+        self.buffer += self.decoder.decode(b)
+        return self._emit(final=False)
+
+    def flush(self) -> str:
+        """emit whatever is left once the sequence is over"""
+        if self.stopped:
+            return ""
+        self.buffer += self.decoder.decode(b"", final=True)
+        return self._emit(final=True)
+
+    def _emit(self, final: bool) -> str:
+        hits = [(self.buffer.find(s), s) for s in self.stop if s in self.buffer]
+        if hits:
+            cut = min(hits)[0]
+            out, self.buffer = self.buffer[:cut], ""
+            self.stopped = True
+            return out
+        # keep back the longest tail that could still grow into a stop string
+        hold = 0
+        if not final:
+            for s in self.stop:
+                for n in range(min(len(s) - 1, len(self.buffer)), hold, -1):
+                    if self.buffer.endswith(s[:n]):
+                        hold = n
+                        break
+        out = self.buffer[: len(self.buffer) - hold]
+        self.buffer = self.buffer[len(self.buffer) - hold :]
+        return out
+
+
+def stream(
+    engine: Engine,
+    tokenizer: Tokenizer,
+    prompts: List[str],
+    max_new_tokens: int = 256,
+    stop: Sequence[str] = (),
+) -> Iterator[Tuple[int, str]]:
+    """generate for all prompts at once, yielding (prompt index, text delta) pairs"""
+    requests, streams = [], []
+    for i, prompt in enumerate(prompts):
+        tokens = tokenizer.encode(prompt, bos=True, eos=False)
+        requests.append(engine.submit(Request(tokens, max_new_tokens, request_id=i)))
+        streams.append(TextStream(tokenizer, stop))
+    seen = [0] * len(requests)
+    live = set(range(len(requests)))
+
+    while live:
+        engine.step()
+        for i in list(live):
+            req, text = requests[i], streams[i]
+            for token in req.output[seen[i] :]:
+                if token == tokenizer.eos_id:
+                    engine.cancel(req, "eos")
+                    break
+                delta = text.push(token)
+                if delta:
+                    yield i, delta
+                if text.stopped:
+                    engine.cancel(req, "stop")
+                    break
+            seen[i] = len(req.output)
+            if req.finish_reason is not None:
+                delta = text.flush()
+                if delta:
+                    yield i, delta
+                live.discard(i)
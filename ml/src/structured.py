@@ -0,0 +1,102 @@
+"""
+Structured output. For fields drawn from a small closed set, such as the mediqa
+section headers (data["section_header"].unique()), classify() scores every
+candidate in one batched forward pass instead of generating it.
+
+Otherwise the caller declares the skeleton of the response as literal
+strings and generated fields. Whenever the skeleton forces the next tokens (a
+header, a section marker) the engine appends them in one prefill chunk instead
+of sampling them one decode step at a time. Example for the mediqa format:
+
+>>> req = Request(enc.encode(f"<<context>>\n{transcript}\n\n<<summary>>\n", bos=True, eos=False))
+>>> req.skeleton = mediqa_skeleton(enc)
+>>> engine.submit(req)
+"""
+
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple, Union
+
+import torch
+
+# This is a very hacky and temporary solution to make this work as a standalone script
+try:
+    from src.model import Transformer
+    from src.streaming import TextStream
+    from src.tokenizer import Tokenizer
+except ImportError:
+    from model import Transformer
+    from streaming import TextStream
+    from tokenizer import Tokenizer
+
+
+@dataclass
+class Field:
+    name: str
+    stop: Optional[str] = None  # text that ends the field, None runs to eos / max_new_tokens
+
+
+class Skeleton:
+    """walks the declared parts as tokens are sampled, handing back the tokens to force"""
+
+    def __init__(self, tokenizer: Tokenizer, parts: Sequence[Union[str, Field]]):
+        self.tokenizer = tokenizer
+        self.parts = list(parts)
+        self.index = 0
+        self.stream: Optional[TextStream] = None
+        self.forced = 0  # tokens appended without a decode step
+
+    def _force_literals(self) -> Tuple[List[int], bool]:
+        # consume consecutive literals, stopping at the next field (or the end)
+        text = ""
+        while self.index < len(self.parts) and isinstance(self.parts[self.index], str):
+            text += self.parts[self.index]
+            self.index += 1
+        tokens = self.tokenizer.encode_continuation(text) if text else []
+        self.forced += len(tokens)
+        done = self.index >= len(self.parts)
+        if not done:
+            field = self.parts[self.index]
+            self.stream = TextStream(self.tokenizer, [field.stop] if field.stop else [])
+        return tokens, done
+
+    def start(self) -> List[int]:
+        """tokens forced before anything is sampled, appended to the prompt"""
+        tokens, _ = self._force_literals()
+        return tokens
+
+    def advance(self, token: int) -> Tuple[List[int], bool]:
+        """feed a sampled token, returns (tokens to force next, whether the skeleton is complete)"""
+        if self.stream is None:
+            return [], False
+        self.stream.push(token)
+        if not self.stream.stopped:
+            return [], False
+        self.stream = None
+        self.index += 1  # the field is complete
+        return self._force_literals()
+
+
+def mediqa_skeleton(tokenizer: Tokenizer) -> Skeleton:
+    """datasets/mediqa: the prompt ends with "<<summary>>\\n", the model writes summary then topic"""
+    return Skeleton(tokenizer, [Field("summary", stop="\n\n"), "<<topic>>\n", Field("topic")])
+
+
+def combined_sum_skeleton(tokenizer: Tokenizer) -> Skeleton:
+    """datasets/combined_sum "Find the topic and summarize" format, the prompt ends with "\\n\\n" """
+    return Skeleton(
+        tokenizer, ["Topic: ", Field("topic", stop="\n\n"), "Summary: ", Field("summary")]
+    )
+
+
+def classify(
+    model: Transformer, tokenizer: Tokenizer, prompt: str, labels: List[str]
+) -> List[Tuple[str, float]]:
+    """
+    Rank a closed set of labels as continuations of prompt (e.g. a transcript and summary
+    ending in "<<topic>>\\n"), returns (label, log-probability) pairs, best first.
+    """
+    device = model.norm.weight.device
+    prefix = torch.tensor(tokenizer.encode(prompt, bos=True, eos=False), device=device)
+    candidates = [tokenizer.encode_continuation(label) + [tokenizer.eos_id] for label in labels]
+    scores = model.score_labels(prefix, candidates).tolist()
+    return sorted(zip(labels, scores), key=lambda x: x[1], reverse=True)
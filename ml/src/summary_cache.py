@@ -0,0 +1,209 @@
+"""
+Content-addressed cache of generated summaries.
+
+Entries are keyed on a hash of the normalized transcript (unicode NFC, collapsed
+whitespace), the model fingerprint and the generation parameters, so a re-opened
+recording or a retried request is answered without generating again. A small
+in-memory LRU sits in front of an optional on-disk store, both evicting least
+recently used entries once over their byte budget. Identical requests that arrive
+while the first is still generating wait for its result instead of running again.
+
+>>> cache = SummaryCache(model_fingerprint(model), directory="cache/summaries")
+>>> key = cache.key(transcript, max_new_tokens=256, temperature=0.0)
+>>> summary = cache.get_or_compute(key, lambda: summarize(transcript))
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import torch
+
+
+def normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+@torch.no_grad()
+def model_fingerprint(model: torch.nn.Module, sample: int = 256) -> str:
+    """hash of every tensor's name, shape and leading values, cheap enough to run at startup"""
+    h = hashlib.sha256()
+    for name, t in model.state_dict().items():
+        h.update(f"{name}{tuple(t.shape)}".encode())
+        h.update(t.detach().flatten()[:sample].float().cpu().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+@dataclass
+class SummaryCacheStats:
+    hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    coalesced: int = 0  # requests that waited on an identical in-flight generation
+    evictions: int = 0
+    disk_evictions: int = 0
+
+
+class SummaryCache:
+    def __init__(
+        self,
+        model_id: str,
+        directory: Optional[str] = None,
+        max_bytes: int = 64 * 2**20,
+        max_disk_bytes: int = 2**30,
+    ):
+        self.model_id = model_id
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.entries: "OrderedDict[str, Any]" = OrderedDict()
+        self.sizes: Dict[str, int] = {}
+        self.bytes = 0
+        self.disk: "OrderedDict[str, int]" = OrderedDict()  # key -> file size, oldest access first
+        self.disk_bytes = 0
+        self.inflight: Dict[str, Any] = {}  # key -> Future of the running generation
+        self.lock = threading.Lock()
+        self.stats = SummaryCacheStats()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            files = [f for f in os.listdir(directory) if f.endswith(".json")]
+            files.sort(key=lambda f: os.path.getmtime(os.path.join(directory, f)))
+            for f in files:
+                size = os.path.getsize(os.path.join(directory, f))
+                self.disk[f[: -len(".json")]] = size
+                self.disk_bytes += size
+
+    def key(self, transcript: str, **params) -> str:
+        """cache key of a transcript under this model and the given generation parameters"""
+        blob = json.dumps([normalize(transcript), self.model_id, params], sort_keys=True)
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def _remember(self, key: str, value: Any, size: int):
+        # in-memory LRU insert, the caller holds the lock
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        if size > self.max_bytes:
+            return
+        self.entries[key] = value
+        self.sizes[key] = size
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            old, _ = self.entries.popitem(last=False)
+            self.bytes -= self.sizes.pop(old)
+            self.stats.evictions += 1
+
+    def get(self, key: str) -> Optional[Any]:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats.hits += 1
+                return self.entries[key]
+            if key in self.disk:
+                with open(self._path(key)) as f:
+                    data = f.read()
+                os.utime(self._path(key))  # keeps the access order across restarts
+                self.disk.move_to_end(key)
+                value = json.loads(data)
+                self._remember(key, value, len(data))
+                self.stats.hits += 1
+                self.stats.disk_hits += 1
+                return value
+            self.stats.misses += 1
+            return None
+
+    def put(self, key: str, value: Any):
+        """store a json-serializable value in memory and on disk"""
+        data = json.dumps(value)
+        with self.lock:
+            self._remember(key, value, len(data))
+            if self.directory is None or key in self.disk or len(data) > self.max_disk_bytes:
+                return
+            tmp = self._path(key) + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+            self.disk[key] = len(data)
+            self.disk_bytes += len(data)
+            while self.disk_bytes > self.max_disk_bytes:
+                old, size = self.disk.popitem(last=False)
+                os.remove(self._path(old))
+                self.disk_bytes -= size
+                self.stats.disk_evictions += 1
+
+    def _claim(self, key: str, new_future: Callable[[], Any]):
+        # (future, owner): the owner runs the generation, everyone else waits on it
+        with self.lock:
+            if key in self.inflight:
+                self.stats.coalesced += 1
+                return self.inflight[key], False
+            future = self.inflight[key] = new_future()
+            return future, True
+
+    def _release(self, key: str):
+        with self.lock:
+            self.inflight.pop(key, None)
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any]) -> Any:
+        """cached value of key, running compute() at most once across concurrent threads"""
+        value = self.get(key)
+        if value is not None:
+            return value
+        future, owner = self._claim(key, Future)
+        if not owner:
+            return future.result()
+        try:
+            value = compute()
+            self.put(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._release(key)
+
+    async def aget_or_compute(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        asyncio version of get_or_compute, for use on a single event loop. Waiters get
+        compute()'s result or exception; if the running compute() is cancelled instead,
+        one of them takes over.
+        """
+        while True:
+            value = self.get(key)
+            if value is not None:
+                return value
+            future, owner = self._claim(key, asyncio.get_running_loop().create_future)
+            if owner:
+                break
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # this waiter was cancelled itself
+                # the owner was cancelled before finishing, compute it here instead
+        try:
+            value = await compute()
+            self.put(key, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # retrieved: no "never retrieved" warning when nobody waited
+            raise
+        finally:
+            self._release(key)
@@ -26,6 +26,7 @@ class Tokenizer:
         self.pad_id: int = self.sp_model.pad_id()
         #print(f"#words: {self.n_words} - BOS ID: {self.bos_id} - EOS ID: {self.eos_id}")
         assert self.sp_model.vocab_size() == self.sp_model.get_piece_size()
+        self._piece_bytes = None
 
     def encode(self, s: str, bos: bool, eos: bool) -> List[int]:
         assert type(s) is str
@@ -39,6 +40,31 @@ class Tokenizer:
     def decode(self, t: List[int]) -> str:
         return self.sp_model.decode(t)
 
+    def encode_continuation(self, s: str) -> List[int]:
+        # encode s as it appears mid-sequence, i.e. without sentencepiece's dummy-prefix space
+        prefix = self.sp_model.encode("\n")
+        t = self.sp_model.encode("\n" + s)
+        assert t[:len(prefix)] == prefix
+        return t[len(prefix):]
+
+    def piece_bytes(self) -> List[bytes]:
+        # the utf-8 bytes every token id contributes to decoded text, for incremental decoding
+        if self._piece_bytes is None:
+            table = []
+            for i in range(self.n_words):
+                t = self.sp_model.id_to_piece(i)
+                if self.sp_model.is_control(i):
+                    b = b''
+                elif self.sp_model.is_unknown(i):
+                    b = ' \u2047 '.encode('utf-8')
+                elif self.sp_model.is_byte(i):
+                    b = bytes([int(t[3:5], 16)]) # e.g. '<0x0A>' is the raw byte 0x0A
+                else:
+                    b = t.replace('▁', ' ').encode('utf-8')
+                table.append(b)
+            self._piece_bytes = table
+        return self._piece_bytes
+
     def export(self):
 
         # get all the tokens (postprocessed) and their scores as floats
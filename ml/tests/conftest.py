@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+# model.py needs these at import time
+pytest.importorskip("numpy")
+pytest.importorskip("apex")
+torch = pytest.importorskip("torch")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from model import ModelArgs, Transformer  # noqa: E402
+
+
+@pytest.fixture
+def tiny_model():
+    torch.manual_seed(0)
+    params = ModelArgs(dim=64, n_layers=2, n_heads=4, n_kv_heads=2, vocab_size=100, max_seq_len=64, multiple_of=16)
+    return Transformer(params).eval()
@@ -0,0 +1,45 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from model import ModelArgs, Transformer
+
+pytest.importorskip("sentencepiece")  # beam.py imports the tokenizer
+
+from beam import BeamSearch  # noqa: E402
+
+
+def exhaustive(model, prompt, max_new_tokens, eos_id, length_penalty):
+    """best length-normalized continuation over every sequence the search could return"""
+    best_score, best = -float("inf"), None
+    stack = [([], 0.0)]
+    while stack:
+        tokens, score = stack.pop()
+        with torch.inference_mode():
+            logprobs = F.log_softmax(model(torch.tensor([prompt + tokens]))[0, -1].float(), dim=-1)
+        for token, logprob in enumerate(logprobs.tolist()):
+            seq = tokens + [token]
+            if token == eos_id or len(seq) == max_new_tokens:
+                normalized = (score + logprob) / len(seq) ** length_penalty
+                if normalized > best_score:
+                    best_score, best = normalized, seq
+            else:
+                stack.append((seq, score + logprob))
+    return best
+
+
+def test_no_early_stopping_with_length_penalty_matches_exhaustive_search():
+    torch.manual_seed(6)
+    params = ModelArgs(dim=64, n_layers=2, n_heads=4, n_kv_heads=2, vocab_size=4, max_seq_len=64, multiple_of=16)
+    model = Transformer(params).eval()
+    eos_id = 1
+    with torch.no_grad():
+        # a likely eos fills the finished hypotheses after the first step
+        model.output.weight[eos_id] *= 20
+    prompt, max_new_tokens = [0, 2, 3], 5
+
+    search = BeamSearch(model, num_beams=2, length_penalty=2.0, early_stopping=False, block_size=4)
+    out = search.generate(torch.tensor([prompt]), max_new_tokens, eos_id=eos_id)
+    expected = exhaustive(model, prompt, max_new_tokens, eos_id, 2.0)
+    assert len(expected) > 1  # the best hypothesis is longer than the first finished one
+    assert out[0, len(prompt) :].tolist() == expected
@@ -0,0 +1,93 @@
+import torch
+
+from engine import Engine, Request
+from paged_cache import block_bytes, setup_paged_caches
+from prefix_cache import PrefixCache
+
+
+def ragged_prompts(n=5, vocab_size=100):
+    torch.manual_seed(1)
+    return [torch.randint(1, vocab_size, (length,)).tolist() for length in [3, 11, 7, 20, 5][:n]]
+
+
+def reference(model, prompts, max_new_tokens):
+    """per-prompt greedy Transformer.generate"""
+    return [
+        model.generate(torch.tensor([p]), max_new_tokens, temperature=0.0)[0, len(p) :].tolist()
+        for p in prompts
+    ]
+
+
+def test_engine_matches_generate(tiny_model):
+    prompts = ragged_prompts()
+    expected = reference(tiny_model, prompts, 8)
+    # fewer slots than prompts and short prefill chunks: backfilling and chunked prompts
+    engine = Engine(tiny_model, max_batch_size=3, prefill_chunk=8)
+    assert engine.generate(prompts, max_new_tokens=8) == expected
+    assert engine.stats.prompt_tokens == sum(len(p) for p in prompts)
+
+
+def test_paged_engine_matches_contiguous(tiny_model):
+    # a shared 6-token preamble: later and recomputed requests fork its pinned blocks,
+    # the second one half full, and 16 blocks of 4 tokens force preemption
+    torch.manual_seed(2)
+    preamble = torch.randint(1, 100, (6,)).tolist()
+    prompts = [preamble + p for p in ragged_prompts()]
+    expected = Engine(tiny_model, max_batch_size=4, prefill_chunk=8).generate(prompts, max_new_tokens=12)
+
+    prefixes = PrefixCache()
+    prefixes.register(preamble)
+    allocator = setup_paged_caches(tiny_model, 16 * block_bytes(tiny_model, 4), block_size=4)
+    engine = Engine(tiny_model, max_batch_size=4, prefill_chunk=8, prefix_cache=prefixes, allocator=allocator)
+    assert engine.generate(prompts, max_new_tokens=12) == expected
+    assert engine.stats.preempted > 0
+    assert prefixes.stats.hits > 0
+    assert engine.stats.prompt_tokens == sum(len(p) for p in prompts)  # preempted ones only once
+    # only the pinned preamble is left
+    assert allocator.num_free_blocks == allocator.num_blocks - 1 - allocator.blocks_for(len(preamble))
+
+
+def test_fork_shares_blocks_until_written(tiny_model):
+    allocator = setup_paged_caches(tiny_model, 6 * block_bytes(tiny_model, 4), block_size=4)
+    pool = allocator.caches[0].k_pool
+    assert allocator.reserve("a", 0, 6)
+    for block in allocator.tables["a"]:
+        pool[block] = torch.randn_like(pool[block])
+    before = pool[allocator.tables["a"]].clone()
+
+    allocator.fork("a", "b", 6)
+    assert allocator.tables["b"] == allocator.tables["a"]
+    assert [allocator.refcount[b] for b in allocator.tables["a"]] == [2, 2]
+    # writing position 6 of b unshares only the half-full second block, copying it
+    assert allocator.reserve("b", 6, 7)
+    assert allocator.tables["b"][0] == allocator.tables["a"][0]
+    assert allocator.tables["b"][1] != allocator.tables["a"][1]
+    assert torch.equal(pool[allocator.tables["b"]], before)
+    assert [allocator.refcount[b] for b in allocator.tables["b"]] == [2, 1]
+
+    # out of blocks: reserve refuses without touching the table
+    assert not allocator.reserve("b", 7, 24)
+    assert len(allocator.tables["b"]) == 2
+    allocator.free("a")
+    allocator.free("b")
+    assert allocator.num_free_blocks == allocator.num_blocks - 1
+
+
+class Literal:
+    """a skeleton that opens with a forced literal, then lets the model run"""
+
+    def start(self):
+        return [7, 8]
+
+    def advance(self, token):
+        return [], False
+
+
+def test_prompt_tokens_count_skeleton_requests(tiny_model):
+    prompts = ragged_prompts(2)
+    engine = Engine(tiny_model, max_batch_size=2)
+    requests = [Request(prompts[0], max_new_tokens=4), Request(prompts[1], max_new_tokens=4, skeleton=Literal())]
+    for _ in engine.run(requests):
+        pass
+    assert engine.stats.prompt_tokens == sum(len(p) for p in prompts)
+    assert engine.stats.forced_tokens == 2
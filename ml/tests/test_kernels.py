@@ -0,0 +1,30 @@
+import pytest
+import torch
+
+import kernels
+from model import KERNELS, ModelArgs
+
+# the tiny_model shapes; 300 positions take chunked attention past its 256-query chunks
+PARAMS = ModelArgs(dim=64, n_layers=2, n_heads=4, n_kv_heads=2, vocab_size=100, max_seq_len=64, multiple_of=16)
+SEQLEN = 300
+
+MATRIX = [
+    (op, name, case)
+    for op, backends in KERNELS.items()
+    for name in backends
+    for case in kernels.cases(op, PARAMS, 1, 8, torch.float32, "cpu")
+]
+
+
+@pytest.fixture(scope="module")
+def results():
+    torch.manual_seed(0)
+    return kernels.check(PARAMS, batch_size=2, seqlen=SEQLEN)
+
+
+@pytest.mark.parametrize("op,name,case", MATRIX, ids=["/".join(m) for m in MATRIX])
+def test_backend_matches_eager(results, op, name, case):
+    rows = [r for r in results if r[:2] == (op, name) and r[3] == case]
+    assert len(rows) == 2  # float32 and bfloat16
+    for _, _, dtype, _, err, ok in rows:
+        assert ok, f"{op}/{name} {case} {dtype}: max err {err:.2e}"
@@ -0,0 +1,28 @@
+import torch
+
+from engine import Engine, Request
+from lora import attach_adapters
+
+
+def random_adapter(adapters, rank=4):
+    return {
+        m.key: (0.1 * torch.randn(rank, m.lora_a.size(2)), 0.1 * torch.randn(m.lora_b.size(1), rank))
+        for m in adapters.modules
+    }
+
+
+def test_generate_after_adapter_engine_step(tiny_model):
+    prompt = torch.randint(tiny_model.vocab_size, (1, 6))
+    expected = tiny_model.generate(prompt, 4, temperature=0.0)
+    adapters = attach_adapters(tiny_model)
+    adapters.add("a", random_adapter(adapters))
+
+    engine = Engine(tiny_model, max_batch_size=2, adapters=adapters)
+    for adapter in ["a", "a"]:
+        engine.submit(Request(prompt[0].tolist(), 4, adapter=adapter))
+    engine.step()
+    assert adapters.ids is None
+
+    # a different batch size, then the same one: both must run on the bare base
+    assert torch.equal(tiny_model.generate(prompt, 4, temperature=0.0), expected)
+    assert torch.equal(tiny_model.generate(prompt.repeat(2, 1), 4, temperature=0.0)[:1], expected)
@@ -0,0 +1,54 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from model import ChunkedCrossEntropy, Int8KVCache, KVCache
+
+
+@pytest.mark.parametrize("cache_cls", [KVCache, Int8KVCache])
+def test_ragged_padding_never_overwrites_real_keys(cache_cls):
+    torch.manual_seed(0)
+    cache = cache_cls(max_batch_size=2, max_seq_len=8, n_kv_heads=1, head_dim=4)
+    # row 0 has two real tokens filling the last slots, its padding runs past the end
+    xk, xv = torch.randn(2, 4, 1, 4), torch.randn(2, 4, 1, 4)
+    keys, values, _ = cache.update(torch.tensor([6, 0]), xk, xv)
+    atol = 0.05 if cache_cls is Int8KVCache else 0.0
+    torch.testing.assert_close(keys[0, 6:8], xk[0, :2], atol=atol, rtol=0)
+    torch.testing.assert_close(values[0, 6:8], xv[0, :2], atol=atol, rtol=0)
+    torch.testing.assert_close(keys[1, :4], xk[1], atol=atol, rtol=0)
+
+
+def test_chunked_cross_entropy_matches_cross_entropy():
+    torch.manual_seed(0)
+    h = torch.randn(37, 16, requires_grad=True)
+    weight = torch.randn(50, 16, requires_grad=True)
+    targets = torch.randint(50, (37,))
+    targets[[0, 9, 10, 36]] = -1  # ignored rows, one of them in the short last chunk
+
+    loss = ChunkedCrossEntropy.apply(h, weight, targets, 8)  # 8 does not divide 37
+    grad_h, grad_w = torch.autograd.grad(loss, (h, weight))
+    expected = F.cross_entropy(h @ weight.t(), targets, ignore_index=-1)
+    expected_h, expected_w = torch.autograd.grad(expected, (h, weight))
+
+    torch.testing.assert_close(loss, expected)
+    torch.testing.assert_close(grad_h, expected_h)
+    torch.testing.assert_close(grad_w, expected_w)
+    assert grad_h[[0, 9, 10, 36]].abs().max() == 0
+
+
+def test_loss_chunk_size_keeps_loss_and_gradients(tiny_model):
+    torch.manual_seed(0)
+    tokens = torch.randint(100, (2, 24))
+    targets = torch.randint(100, (2, 24))
+    targets[0, -5:] = -1
+    grads = []
+    for chunk_size in [0, 7]:
+        tiny_model.zero_grad()
+        tiny_model.loss_chunk_size = chunk_size
+        tiny_model(tokens, targets)
+        tiny_model.last_loss.backward()
+        grads.append((tiny_model.last_loss.detach(), [p.grad.clone() for p in tiny_model.parameters()]))
+    (loss, full), (chunked_loss, chunked) = grads
+    torch.testing.assert_close(chunked_loss, loss)
+    for a, b in zip(chunked, full):
+        torch.testing.assert_close(a, b)
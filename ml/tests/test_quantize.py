@@ -0,0 +1,41 @@
+import torch
+import torch.nn.functional as F
+
+from quantize import Int8Linear, kv_cache_report, quantize_model
+
+
+def test_kv_cache_report(tiny_model):
+    tokens = torch.randint(tiny_model.vocab_size, (2, 40))
+    ref_bytes, int8_bytes, rel_err, max_err = kv_cache_report(tiny_model, tokens, decode_steps=8)
+    assert int8_bytes < ref_bytes
+    assert 0 < rel_err < 0.05
+    assert max_err > 0
+
+
+def test_int8_linear_matches_dequantized_weights():
+    torch.manual_seed(0)
+    q = Int8Linear.from_linear(torch.nn.Linear(64, 96, bias=False))
+    x = torch.randn(3, 5, 64)
+    expected = F.linear(x, q.weight.float()) * q.scales
+    out = q(x)
+    assert out.shape == (3, 5, 96)
+    # quantizing x adds a little error on top of the weight rounding
+    assert ((out - expected).norm() / expected.norm()).item() < 0.02
+
+
+def test_int8_linear_rows_are_independent():
+    torch.manual_seed(0)
+    q = Int8Linear.from_linear(torch.nn.Linear(64, 96, bias=False))
+    x = torch.randn(2, 5, 64)
+    alone = q(x[:1])
+    x[1] *= 100  # a large neighbour must not change the first row's activation scales
+    assert torch.equal(q(x)[:1], alone)
+
+
+def test_quantized_model_generates_like_fp32(tiny_model):
+    tokens = torch.randint(tiny_model.vocab_size, (2, 24))
+    with torch.no_grad():
+        ref = tiny_model(tokens, all_logits=True)
+        quantize_model(tiny_model)
+        out = tiny_model(tokens, all_logits=True)
+    assert ((out - ref).norm() / ref.norm()).item() < 0.05
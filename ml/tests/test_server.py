@@ -0,0 +1,167 @@
+import asyncio
+import gc
+import json
+
+import pytest
+
+pytest.importorskip("sentencepiece")  # server.py imports the tokenizer module
+
+from engine import Engine  # noqa: E402
+from server import Server  # noqa: E402
+from summary_cache import SummaryCache  # noqa: E402
+
+
+class LetterTokenizer:
+    eos_id = -1  # never sampled
+
+    def encode(self, s, bos, eos):
+        return [3 + ord(c) % 90 for c in s]
+
+    def piece_bytes(self):
+        return [bytes([97 + i % 26]) for i in range(100)]
+
+
+class Writer:
+    """collects what the server writes, raising on the drain after fail_after successful ones"""
+
+    def __init__(self, fail_after=None):
+        self.data = b""
+        self.drains = 0
+        self.fail_after = fail_after
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        if self.fail_after is not None and self.drains >= self.fail_after:
+            raise ConnectionResetError()
+        self.drains += 1
+
+    def close(self):
+        pass
+
+    def json(self):
+        return json.loads(self.data.split(b"\r\n\r\n", 1)[1])
+
+    def status(self):
+        return int(self.data.split(b" ", 2)[1])
+
+
+def run_server(model, requests, max_queue=64):
+    """run the (writer, body, delay) requests against one server, returns the loop's unhandled errors"""
+    errors = []
+
+    async def main():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        engine = Engine(model, max_batch_size=2)
+        server = Server(engine, LetterTokenizer(), batch_window=0.0, max_queue=max_queue, cache=SummaryCache("test"))
+        scheduler = asyncio.create_task(server.schedule())
+
+        async def client(writer, body, delay):
+            await asyncio.sleep(delay)
+            try:
+                await server.generate(writer, body)
+            except ConnectionError:
+                pass
+
+        await asyncio.gather(*(client(*r) for r in requests))
+        scheduler.cancel()
+        gc.collect()
+        await asyncio.sleep(0)
+        return server
+
+    server = asyncio.run(main())
+    gc.collect()
+    return server, errors
+
+
+def test_leader_disconnect_does_not_fail_coalesced_requests(tiny_model):
+    body = {"prompt": "hello there", "max_new_tokens": 6}
+    leader, follower = Writer(fail_after=0), Writer()
+    server, errors = run_server(tiny_model, [(leader, dict(body, stream=True), 0), (follower, body, 0.001)])
+    assert server.cache.stats.coalesced == 1
+    result = follower.json()
+    assert follower.status() == 200 and result["tokens"] == 6 and not result["cached"]
+    assert not errors
+
+
+def test_failed_generation_reaches_followers_without_warnings(tiny_model):
+    body = {"prompt": "hello there", "max_new_tokens": 6}
+    first, second = Writer(), Writer()
+    _, errors = run_server(tiny_model, [(first, body, 0), (second, body, 0)], max_queue=0)
+    assert first.status() == 503 and second.status() == 503
+    assert not errors
+
+
+def test_cache_hits_report_their_own_latency(tiny_model):
+    body = {"prompt": "hello there", "max_new_tokens": 6}
+    first, second = Writer(), Writer()
+    run_server(tiny_model, [(first, body, 0), (second, body, 0.5)])
+    fresh, cached = first.json(), second.json()
+    assert not fresh["cached"] and cached["cached"]
+    assert cached["text"] == fresh["text"]
+    assert cached["latency"] < 0.1
+
+
+async def post(server, body: bytes) -> Writer:
+    """POST body to /generate through Server.handle"""
+    reader = asyncio.StreamReader()
+    reader.feed_data(b"POST /generate HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+    reader.feed_eof()
+    writer = Writer()
+    await server.handle(reader, writer)
+    return writer
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b'{"prompt": 5}',
+        b'{"prompt": ""}',
+        b'["hello"]',
+        b'{"transcript": null}',
+        b'{"prompt": "hi", "max_new_tokens": "many"}',
+        b'{"prompt": "hi", "max_new_tokens": 0}',
+        b'{"prompt": "hi", "stop": "\\n"}',
+        b"not json",
+    ],
+)
+def test_malformed_bodies_get_400(tiny_model, body):
+    async def main():
+        server = Server(Engine(tiny_model, max_batch_size=2), LetterTokenizer())
+        return await asyncio.wait_for(post(server, body), timeout=10)
+
+    writer = asyncio.run(main())
+    assert writer.status() == 400 and "error" in writer.json()
+
+
+def test_failed_step_fails_its_requests_and_keeps_serving(tiny_model):
+    body = {"prompt": "hello there", "max_new_tokens": 6}
+    failing, streaming, later = Writer(), Writer(), Writer()
+
+    async def main():
+        engine = Engine(tiny_model, max_batch_size=2)
+        server = Server(engine, LetterTokenizer(), batch_window=0.0)
+        step, calls = engine.step, []
+
+        def flaky_step():
+            calls.append(1)
+            if len(calls) == 3:
+                raise RuntimeError("boom")
+            return step()
+
+        engine.step = flaky_step
+        scheduler = asyncio.create_task(server.schedule())
+        both = asyncio.gather(
+            server.generate(failing, body), server.generate(streaming, dict(body, prompt="hi", stream=True))
+        )
+        await asyncio.wait_for(both, timeout=10)
+        await asyncio.wait_for(server.generate(later, body), timeout=10)
+        assert not scheduler.done()
+        scheduler.cancel()
+
+    asyncio.run(main())
+    assert failing.status() == 500 and "boom" in failing.json()["error"]
+    lines = [json.loads(line) for line in streaming.data.split(b"\r\n") if line.startswith(b"{")]
+    assert lines[-1]["done"] and "boom" in lines[-1]["error"]
+    assert later.status() == 200 and later.json()["tokens"] == 6
@@ -0,0 +1,38 @@
+import pytest
+
+pytest.importorskip("sentencepiece")  # session.py imports the tokenizer module
+
+from session import SummarySession  # noqa: E402
+
+
+class CharTokenizer:
+    """one token per character, enough to drive a session without a sentencepiece model"""
+
+    bos_id, eos_id = 1, 2
+
+    def encode(self, s, bos, eos):
+        return [self.bos_id] * bos + self.encode_continuation(s) + [self.eos_id] * eos
+
+    def encode_continuation(self, s):
+        return [3 + ord(c) % 90 for c in s]
+
+    def decode(self, tokens):
+        return "".join(chr(t) for t in tokens)
+
+
+def test_overflow_keeps_updates_incremental(tiny_model):
+    # 64 positions: 12 header/footer, 8 generated, 44 transcript tokens
+    session = SummarySession(tiny_model, CharTokenizer(), max_new_tokens=8, header="<<ctx>>\n", footer="\nsum:\n")
+    turn = "ab"
+    prefills = []
+    for _ in range(40):
+        before = session.stats.prefill_tokens
+        session.update(turn)
+        prefills.append(session.stats.prefill_tokens - before)
+    incremental = len(turn) + len(session.sep) + len(session.footer)
+    after_overflow = prefills[prefills.index(max(prefills)) :]
+    assert session.stats.recomputed > 1
+    # each crop frees room for more than one turn that only forwards the new text and footer
+    assert after_overflow.count(incremental) > 2 * session.stats.recomputed - 2
+    assert sum(after_overflow) < len(after_overflow) * 20
+    session.close()
@@ -0,0 +1,53 @@
+import copy
+
+import pytest
+import torch
+
+pytest.importorskip("sentencepiece")  # speculative.py imports the tokenizer
+
+from speculative import PromptLookupDecoder, SpeculativeDecoder  # noqa: E402
+
+
+@pytest.fixture
+def target(tiny_model):
+    # at init the blocks barely touch the residual stream and greedy decoding just
+    # repeats the last token, larger block weights give varied continuations
+    with torch.no_grad():
+        for layer in tiny_model.layers:
+            for p in layer.parameters():
+                if p.dim() == 2:
+                    p.mul_(5)
+    return tiny_model
+
+
+def greedy(model, idx, max_new_tokens):
+    return model.generate(idx, max_new_tokens, temperature=0.0)[0, idx.size(1) :].tolist()
+
+
+def test_draft_model_matches_greedy(target):
+    torch.manual_seed(3)
+    idx = torch.randint(1, 100, (1, 12))
+    expected = greedy(target, idx, 24)
+    assert len(set(expected)) > 4
+    # a perturbed copy of the target: it agrees often but not always
+    draft = copy.deepcopy(target)
+    torch.manual_seed(5)
+    with torch.no_grad():
+        for p in draft.parameters():
+            p.add_(0.002 * torch.randn_like(p))
+    decoder = SpeculativeDecoder(target, draft, k=4, temperature=0.0)
+    out = decoder.generate(idx, 24)
+    assert out[0, idx.size(1) :].tolist() == expected
+    assert 0 < decoder.stats.accepted < decoder.stats.proposed
+
+
+def test_prompt_lookup_matches_greedy(target):
+    torch.manual_seed(4)
+    # a repeated phrase gives the lookup something to copy
+    phrase = torch.randint(1, 100, (6,))
+    idx = torch.cat((phrase, torch.randint(1, 100, (4,)), phrase))[None, :]
+    expected = greedy(target, idx, 24)
+    decoder = PromptLookupDecoder(target, k=4, ngram=2, temperature=0.0)
+    out = decoder.generate(idx, 24)
+    assert out[0, idx.size(1) :].tolist() == expected
+    assert decoder.stats.proposed > 0
@@ -27,6 +27,7 @@ from functools import partial
 
 import torch
 from src.model import Transformer, ModelArgs
+from src.kernels import configure_kernels
 from torch.distributed import destroy_process_group, init_process_group
 from torch.nn.parallel import DistributedDataParallel as DDP
 
@@ -54,8 +55,10 @@ dataset = "tinystories"  # tinystories|tinyshakespeare
 dim = 768
 n_layers = 12
 n_heads = 12
+n_kv_heads = 0  # key/value heads for grouped-query attention, 0 = n_heads; see src/gqa.py to uptrain an MHA checkpoint
 multiple_of = 32
 dropout = 0.1
+fused = False  # one wqkv / w13 matmul per block, checkpoints keep the unfused keys
 # adamw optimizer
 gradient_accumulation_steps = 8  # used to simulate larger batch sizes
 learning_rate = 3e-4  # max learning rate
@@ -76,6 +79,11 @@ device = (
 dtype = "bfloat16"  # float32|bfloat16|float16
 compile = True  # use PyTorch 2.0 to compile the model to be faster
 use_apex = True
+# activation checkpointing, recompute in backward to fit larger micro-batches
+activation_checkpointing = "none"  # none|block|attention
+checkpoint_every = 1  # apply it to every k-th block
+kernels = ""  # rmsnorm/rotary/attention backends, e.g. "attention=chunked", "auto" benchmarks them at startup
+loss_chunk_size = 0  # compute the loss over this many rows of logits at a time, 0 = all at once
 # -----------------------------------------------------------------------------
 config_keys = [
     k
@@ -184,6 +192,7 @@ def compute_intermediate_size(n, ffn_dim_multiplier=1, multiple_of=256):
 
 def save_as_hf(loaded):
     dims_per_head = dim // n_heads
+    kv_heads = n_kv_heads or n_heads
     base = 10000.0
     inv_freq = 1.0 / (
         base ** (torch.arange(0, dims_per_head, 2).float() / dims_per_head)
@@ -195,10 +204,13 @@ def save_as_hf(loaded):
         filename = f"pytorch_model-{layer_i + 1}-of-{n_layers + 1}.bin"
         state_dict = {
             f"model.layers.{layer_i}.self_attn.q_proj.weight": permute(
-                loaded[f"layers.{layer_i}.attention.wq.weight"]
+                loaded[f"layers.{layer_i}.attention.wq.weight"], n_heads, dim, dim
             ),
             f"model.layers.{layer_i}.self_attn.k_proj.weight": permute(
-                loaded[f"layers.{layer_i}.attention.wk.weight"]
+                loaded[f"layers.{layer_i}.attention.wk.weight"],
+                kv_heads,
+                kv_heads * dims_per_head,
+                dim,
             ),
             f"model.layers.{layer_i}.self_attn.v_proj.weight": loaded[
                 f"layers.{layer_i}.attention.wv.weight"
@@ -246,11 +258,13 @@ def save_as_hf(loaded):
         hidden_size=dim,
         intermediate_size=compute_intermediate_size(dim, 1, multiple_of),
         num_attention_heads=n_heads,
+        num_key_value_heads=kv_heads,
         num_hidden_layers=n_layers,
     )
     config.save_pretrained(out_dir)
     hf_config = json.load(open(os.path.join(out_dir, "config.json")))
     hf_config["num_attention_heads"] = n_heads
+    hf_config["num_key_value_heads"] = kv_heads
     hf_config["num_hidden_layers"] = n_layers
     hf_config["hidden_size"] = dim
     hf_config["max_position_embeddings"] = max_seq_len
@@ -288,11 +302,12 @@ model_args = dict(
     dim=dim,
     n_layers=n_layers,
     n_heads=n_heads,
-    n_kv_heads=n_heads,
+    n_kv_heads=n_kv_heads or n_heads,
     vocab_size=32000,
     multiple_of=multiple_of,
     max_seq_len=max_seq_len,
     dropout=dropout,
+    fused=fused,
 )  # start with model_args from command line
 if in_dir == "":
     # init a new model from scratch
@@ -317,8 +332,18 @@ else:
         "max_seq_len",
     ]:
         model_args[k] = checkpoint_model_args[k]
+    # the saved optimizer state follows the parameter layout, keep it when it is loaded.
+    # Without one the weights load either way and the fused flag is honoured
+    if "optimizer" in checkpoint:
+        ckpt_fused = checkpoint_model_args.get("fused", False)
+        if ckpt_fused != fused:
+            print(
+                f"WARNING: fused={fused} ignored, the checkpoint's optimizer state needs fused={ckpt_fused}"
+            )
+        model_args["fused"] = ckpt_fused
     # create the model
     n_heads = model_args["n_heads"]
+    n_kv_heads = model_args["n_kv_heads"] or n_heads
     n_layers = model_args["n_layers"]
     dim = model_args["dim"]
     max_seq_len = model_args["max_seq_len"]
@@ -341,7 +366,16 @@ else:
         # from the same iteration number and best val loss.
         # Otherwise we may be training on a different dataset that needs different metrics
         best_val_loss = checkpoint["best_val_loss"]
+model.set_activation_checkpointing(activation_checkpointing, checkpoint_every)
+model.loss_chunk_size = loss_chunk_size
 model.to(device)
+if kernels:
+    # the forward runs in ptdtype under autocast on cuda, in float32 on cpu
+    tune_dtype = ptdtype if device_type == "cuda" else torch.float32
+    chosen = configure_kernels(
+        kernels, model.params, batch_size, max_seq_len, tune_dtype, device, backward=True
+    )
+    print(f"kernels: {chosen}")
 
 print(f"Assumed max iters: {max_iters} this session + {iter_num_offset} from pretrain = {lr_decay_iters}")
 